@@ -13,6 +13,15 @@ import seaborn as sns
 import time
 import random
 from sklearn.preprocessing import StandardScaler
+import sys
+
+# Shared helpers from the python_scripts folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notebooks', 'python_scripts'))
+from local_feature_store import get_feature_store
+from dashboard_data import SlidingWindow
+from model_cache import ModelCache
+from prediction_store import use_prediction_store, get_prediction_feature_group, read_predictions, get_statuses
+from feature_pipeline import SENSOR_FG_VERSION
 
 # Configuring the web page and setting the page title and icon
 st.set_page_config(
@@ -26,13 +35,6 @@ warnings.filterwarnings("ignore")
 # Setting the title and adding text
 st.title('Parking Occupancy Detection')
 
-# Defining functions
-def fill_nan_with_zero(value):
-    if pd.isna(value):
-        return 0
-    else:
-        return value
-
 # Getting current time and yesterday
 now = datetime.now() + timedelta(hours=2)
 yesterday = now - timedelta(days=1)
@@ -44,79 +46,70 @@ scaler = StandardScaler()
 tab1,tab2 = st.tabs(['Parking place near Building', 'Parking place near Bikelane'])
 
 with tab1:
-    # Logging in to Hopsworks and loading the feature store
+    # Logging in to Hopsworks and loading the feature store (the local one if FEATURE_STORE_BACKEND=local)
     project = hopsworks.login(project = "annikaij", api_key_value=os.environ['HOPSWORKS_API_KEY'])
-    fs = project.get_feature_store()
-
-    # Function to load the building models
-        
-    @st.cache_data()
-    def get_building_mag_model(project=project):
-        mr = project.get_model_registry()
-        building_mag_model = mr.get_model("building_mag_hist_model", version = 2)
-        building_mag_model_dir = building_mag_model.download()
-        return joblib.load(building_mag_model_dir + "/building_mag_hist_model.pkl")
-
-    # Retrieving model
-    building_mag_hist_model = get_building_mag_model()
-
-    @st.cache_data()
-    def get_building_rad_model(project=project):
-        mr = project.get_model_registry()
-        building_rad_model = mr.get_model("building_rad_hist_model", version = 2)
-        building_rad_model_dir = building_rad_model.download()
-        return joblib.load(building_rad_model_dir + "/building_rad_hist_model.pkl")
-
-    # Retrieving model
-    building_rad_hist_model = get_building_rad_model()
+    fs = get_feature_store(project)
+
+    # Loading the feature group with the predictions written by the inference pipeline
+    prediction_fg = get_prediction_feature_group(fs) if use_prediction_store() else None
+
+    # Function to get the status of the latest rows, looked up in the prediction store by id.
+    # Only rows without a stored prediction are scored here, so the page does not grow with the history
+    def get_latest_statuses(df, psensor, mag_model, rad_model, n_rows=3):
+        latest = df.tail(n_rows)
+        stored_predictions = None
+        if prediction_fg is not None and not latest.empty:
+            stored_predictions = read_predictions(prediction_fg, psensor, latest['time'].min())
+        statuses = get_statuses(latest, stored_predictions, mag_model, rad_model)
+        statuses['mag_status'] = statuses['mag_status'].replace(['detection', 'no_detection'], ['Vehicle detected', 'No vehicle detected'])
+        statuses['radar_status'] = statuses['radar_status'].replace(['detection', 'no_detection'], ['Vehicle detected', 'No vehicle detected'])
+        return statuses.rename(columns={'time': 'Time'}).set_index(['Time'])
+
+    # Process-wide model cache, every model is loaded once and shared by all sessions.
+    # New registry versions are swapped in by a background thread
+    @st.cache_resource()
+    def get_model_cache(_project=project):
+        return ModelCache(_project.get_model_registry()).start()
+
+    model_cache = get_model_cache()
+
+    # Retrieving the building models
+    building_mag_hist_model = model_cache.get("building_mag_hist_model")
+    building_rad_hist_model = model_cache.get("building_rad_hist_model")
     
     # Loading the feature group with latest data for building
-    new_building_fg = fs.get_feature_group(name = 'new_building_fg', version = 1)
+    new_building_fg = fs.get_feature_group(name = 'new_building_fg', version = SENSOR_FG_VERSION)
 
-    # Function to loading the feature group with latest data for building as a dataset
-    @st.cache_data()
-    def retrieve_building(feature_group=new_building_fg):
-        new_building_fg = feature_group.select_all()
-        df_building_new = new_building_fg.read(read_options={"use_hive": True})           
-        return df_building_new
+    # Function to keep the last 24 hours of building data in memory, shared by all sessions
+    @st.cache_resource()
+    def get_building_window(_feature_group=new_building_fg):
+        return SlidingWindow(_feature_group)
 
-    # Retrieving building data
-    building_new = retrieve_building()
+    # Retrieving building data, only the rows newer than the last seen time are fetched
+    building_window = get_building_window()
+    building_new = building_window.refresh(now)
+
+    # Getting the magnetic field and radar status of the latest building data
+    building_statuses = get_latest_statuses(building_new, "BUILDING", building_mag_hist_model, building_rad_hist_model)
     
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("Magnetic field prediction")
         
-        # Making the predictions and getting the latest data for magnetic field data
-        building_mag_prediction_data = building_new[['time', 'x', 'y', 'z', 'temperature', 'et0_fao_evapotranspiration']]                       
-        building_mag_prediction_data['et0_fao_evapotranspiration'] = building_mag_prediction_data['et0_fao_evapotranspiration'].apply(fill_nan_with_zero)
-        building_mag_most_recent_prediction = building_mag_prediction_data[['x', 'y', 'z', 'temperature', 'et0_fao_evapotranspiration']]
-        building_mag_most_recent_prediction = building_mag_hist_model.predict(building_mag_most_recent_prediction)
-        building_mag_prediction_data['Status'] = building_mag_most_recent_prediction
-        building_mag_prediction_data['Status'].replace(['detection', 'no_detection'], ['Vehicle detected', 'No vehicle detected'], inplace=True)
-        building_mag_prediction_data = building_mag_prediction_data.rename(columns={'time': 'Time'})
-        building_mag_prediction_data = building_mag_prediction_data.set_index(['Time'])
-        st.dataframe(building_mag_prediction_data[['Status']].tail(3))
+        # Showing the status of the latest magnetic field data
+        st.dataframe(building_statuses[['mag_status']].rename(columns={'mag_status': 'Status'}))
 
     with col2:
         st.subheader("Radar prediction")
         
-        # Making the predictions and getting the latest data for radar data
-        building_rad_prediction_data = building_new[['time', 'radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7', 'temperature', 'et0_fao_evapotranspiration']]                       
-        building_rad_prediction_data['et0_fao_evapotranspiration'] = building_rad_prediction_data['et0_fao_evapotranspiration'].apply(fill_nan_with_zero)
-        building_rad_most_recent_prediction = building_rad_prediction_data[['radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7', 'temperature', 'et0_fao_evapotranspiration']]
-        building_rad_most_recent_prediction = building_rad_hist_model.predict(building_rad_most_recent_prediction)
-        building_rad_prediction_data['Status'] = building_rad_most_recent_prediction
-        building_rad_prediction_data['Status'].replace(['detection', 'no_detection'], ['Vehicle detected', 'No vehicle detected'], inplace=True)
-        building_rad_prediction_data = building_rad_prediction_data.rename(columns={'time': 'Time'})
-        building_rad_prediction_data = building_rad_prediction_data.set_index(['Time'])
-        st.dataframe(building_rad_prediction_data[['Status']].tail(3))
+        # Showing the status of the latest radar data
+        st.dataframe(building_statuses[['radar_status']].rename(columns={'radar_status': 'Status'}))
 
     # Update button
     if st.button("Update Building"):
-        # Clear cached data
-        st.cache_data.clear()
+        # Fetching the new building rows, the bikelane data and the models stay cached
+        building_window.refresh(now, force=True)
         # Immediately rerun the application
         st.experimental_rerun()
 
@@ -166,73 +159,41 @@ with tab1:
         
 with tab2:
 
-    # Function to load the bikelane models
-        
-    @st.cache_data()
-    def get_bikelane_mag_model(project=project):
-        mr = project.get_model_registry()
-        bikelane_mag_model = mr.get_model("bikelane_mag_hist_model", version = 2)
-        bikelane_mag_model_dir = bikelane_mag_model.download()
-        return joblib.load(bikelane_mag_model_dir + "/bikelane_mag_hist_model.pkl")
-
-    # Retrieving model
-    bikelane_mag_hist_model = get_bikelane_mag_model()
-
-    @st.cache_data()
-    def get_bikelane_rad_model(project=project):
-        mr = project.get_model_registry()
-        bikelane_rad_model = mr.get_model("bikelane_rad_hist_model", version = 2)
-        bikelane_rad_model_dir = bikelane_rad_model.download()
-        return joblib.load(bikelane_rad_model_dir + "/bikelane_rad_hist_model.pkl")
-
-    # Retrieving model
-    bikelane_rad_hist_model = get_bikelane_rad_model()
+    # Retrieving the bikelane models
+    bikelane_mag_hist_model = model_cache.get("bikelane_mag_hist_model")
+    bikelane_rad_hist_model = model_cache.get("bikelane_rad_hist_model")
     
     # Loading the feature group with latest data for bikelane
-    new_bikelane_fg = fs.get_feature_group(name = 'new_bikelane_fg', version = 1)
+    new_bikelane_fg = fs.get_feature_group(name = 'new_bikelane_fg', version = SENSOR_FG_VERSION)
+
+    # Function to keep the last 24 hours of bikelane data in memory, shared by all sessions
+    @st.cache_resource()
+    def get_bikelane_window(_feature_group=new_bikelane_fg):
+        return SlidingWindow(_feature_group)
 
-    # Function to loading the feature group with latest data for bikelane as a dataset
-    @st.cache_data()
-    def retrieve_bikelane(feature_group=new_bikelane_fg):
-        new_bikelane_fg = feature_group.select_all()
-        df_bikelane_new = new_bikelane_fg.read(read_options={"use_hive": True})           
-        return df_bikelane_new
+    # Retrieving bikelane data, only the rows newer than the last seen time are fetched
+    bikelane_window = get_bikelane_window()
+    bikelane_new = bikelane_window.refresh(now)
 
-    # Retrieving bikelane data
-    bikelane_new = retrieve_bikelane()
+    # Getting the magnetic field and radar status of the latest bikelane data
+    bikelane_statuses = get_latest_statuses(bikelane_new, "BIKELANE", bikelane_mag_hist_model, bikelane_rad_hist_model)
 
     col1, col2 = st.columns(2)
 
     with col1:    
         st.subheader("Magnetic field prediction")
-        # Making the predictions and getting the latest data for magnetic field data
-        bikelane_mag_prediction_data = bikelane_new[['time', 'x', 'y', 'z', 'temperature', 'et0_fao_evapotranspiration']]                       
-        bikelane_mag_prediction_data['et0_fao_evapotranspiration'] = bikelane_mag_prediction_data['et0_fao_evapotranspiration'].apply(fill_nan_with_zero)
-        bikelane_mag_most_recent_prediction = bikelane_mag_prediction_data[['x', 'y', 'z', 'temperature', 'et0_fao_evapotranspiration']]
-        bikelane_mag_most_recent_prediction = bikelane_mag_hist_model.predict(bikelane_mag_most_recent_prediction)
-        bikelane_mag_prediction_data['Status'] = bikelane_mag_most_recent_prediction
-        bikelane_mag_prediction_data['Status'].replace(['detection', 'no_detection'], ['Vehicle detected', 'No vehicle detected'], inplace=True)
-        bikelane_mag_prediction_data = bikelane_mag_prediction_data.rename(columns={'time': 'Time'})
-        bikelane_mag_prediction_data = bikelane_mag_prediction_data.set_index(['Time'])
-        st.dataframe(bikelane_mag_prediction_data[['Status']].tail(3))
+        # Showing the status of the latest magnetic field data
+        st.dataframe(bikelane_statuses[['mag_status']].rename(columns={'mag_status': 'Status'}))
 
     with col2:  
         st.subheader("Radar prediction")
-        # Making the predictions and getting the latest data for radar data
-        bikelane_rad_prediction_data = bikelane_new[['time', 'radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7', 'temperature', 'et0_fao_evapotranspiration']]                       
-        bikelane_rad_prediction_data['et0_fao_evapotranspiration'] = bikelane_rad_prediction_data['et0_fao_evapotranspiration'].apply(fill_nan_with_zero)
-        bikelane_rad_most_recent_prediction = bikelane_rad_prediction_data[['radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7', 'temperature', 'et0_fao_evapotranspiration']]
-        bikelane_rad_most_recent_prediction = bikelane_rad_hist_model.predict(bikelane_rad_most_recent_prediction)
-        bikelane_rad_prediction_data['Status'] = bikelane_rad_most_recent_prediction
-        bikelane_rad_prediction_data['Status'].replace(['detection', 'no_detection'], ['Vehicle detected', 'No vehicle detected'], inplace=True)
-        bikelane_rad_prediction_data = bikelane_rad_prediction_data.rename(columns={'time': 'Time'})
-        bikelane_rad_prediction_data = bikelane_rad_prediction_data.set_index(['Time'])
-        st.dataframe(bikelane_rad_prediction_data[['Status']].tail(3))
+        # Showing the status of the latest radar data
+        st.dataframe(bikelane_statuses[['radar_status']].rename(columns={'radar_status': 'Status'}))
 
     # Update button
     if st.button("Update Bikelane"):
-        # Clear cached data
-        st.cache_data.clear()
+        # Fetching the new bikelane rows, the building data and the models stay cached
+        bikelane_window.refresh(now, force=True)
         # Immediately rerun the application
         st.experimental_rerun()
 
@@ -3,8 +3,8 @@
 # This notebook consists of 3 parts:
 # 
 # 1. Connecting to the Feature Store and retriving feature views/groups and model
-# 3. Predicting if theres a detection or not
-# 4. Saving the prediction in a new feature view/group
+# 2. Predicting if theres a detection or not, for the rows that were not scored yet
+# 3. Saving the prediction in a new feature view/group
 
 # %%
 # import libraries
@@ -12,110 +12,96 @@ import pandas as pd
 import hopsworks
 import joblib
 
+# Loads the latest registry version of a model, memory mapped if it has an artifact folder
+from model_cache import latest_version, load_registry_model
+
+# Local feature store backend, used instead of Hopsworks if FEATURE_STORE_BACKEND=local
+from local_feature_store import get_feature_store
+from prediction_store import (PREDICTION_FG_NAME, DASHBOARD_SCORED_PATH, get_prediction_feature_group, load_prediction_ids,
+                              read_unscored_rows, score_rows)
+from watermarks import load_watermarks, save_watermarks
+from feature_pipeline import SENSOR_FG_VERSION, sensor_feature_group_name
+from row_keys import key_index_path
+
+# Incremental scoring of the historic feature groups
+from inference_job import run_inference
+from training_engine import TRAINING_SPECS
+
 # %% [markdown]
 # ## 1. Connecting to the Feature Store and retriving feature views/groups and model
 
-# %%
-project = hopsworks.login(project="annikaij")
-fs = project.get_feature_store()
-
 # %%
 # connect to the feature store
 project = hopsworks.login(project="annikaij")
-fs = project.get_feature_store()
+fs = get_feature_store(project)
 
 # %%
-# Get the magnetic bike lane model from the model registry
+# Get the latest version of the magnetic bike lane model from the model registry
 mr = project.get_model_registry()
-mag_bikelane_model = mr.get_model("bikelane_mag_hist_model", version=2)
-model_dir = mag_bikelane_model.download()
-mag_bikelane_model = joblib.load("/workspaces/2nd_semester_project/notebooks/models/bikelane_mag_hist_model.pkl")
-
-# %%
-# Get the magnetic building model from the model registry
-mag_building_model = mr.get_model("building_mag_hist_model", version=2)
-model_dir = mag_building_model.download()
-mag_building_model = joblib.load("/workspaces/2nd_semester_project/notebooks/models/building_mag_hist_model.pkl")
-
-# %%
-# get the radar bikelane model from the model registry
-radar_bikelane_model = mr.get_model("bikelane_rad_hist_model", version=2)
-model_dir = radar_bikelane_model.download()
-radar_bikelane_model = joblib.load("/workspaces/2nd_semester_project/notebooks/models/bikelane_rad_hist_model.pkl")
-
-# %%
-# get the radar building model from the model registry
-radar_building_model = mr.get_model("building_rad_hist_model", version=2)
-model_dir = radar_building_model.download()
-radar_building_model = joblib.load("/workspaces/2nd_semester_project/notebooks/models/building_rad_hist_model.pkl")
-
-# %%
-# Retrieve the feature views for each parking spot
-mag_bikelane_feature_view = fs.get_feature_view(name="hist_bikelane_mag_fv", version=1)
-mag_building_feature_view = fs.get_feature_view(name="hist_building_mag_fv", version=1)
-rad_bikelane_feature_view = fs.get_feature_view(name="hist_bikelane_radar_fv", version=1)
-rad_building_feature_view = fs.get_feature_view(name="hist_building_radar_fv", version=1)
-
-
-# %%
-# Make predictions on the newest magnetic bikelane data
-mag_bikelane_data = mag_bikelane_feature_view.get_batch_data()
-mag_bikelane_pred = mag_bikelane_model.predict(mag_bikelane_data)
-
-# %%
-# Make predictions on the newest magnetic building data
-mag_building_data = mag_building_feature_view.get_batch_data()
-mag_building_pred = mag_building_model.predict(mag_building_data)
-
+mag_bikelane_model = load_registry_model(mr, "bikelane_mag_hist_model", latest_version(mr, "bikelane_mag_hist_model"))
 
 # %%
-# Make predictions on the newest radar bikelane data
-rad_bikelane_data = rad_bikelane_feature_view.get_batch_data()
-rad_bikelane_pred = radar_bikelane_model.predict(rad_bikelane_data)
+# Get the latest version of the magnetic building model from the model registry
+mag_building_model = load_registry_model(mr, "building_mag_hist_model", latest_version(mr, "building_mag_hist_model"))
 
 # %%
-# Make predictions on the newest radar building data
-rad_building_data = rad_building_feature_view.get_batch_data()
-rad_building_pred = radar_building_model.predict(rad_building_data)
+# get the latest version of the radar bikelane model from the model registry
+radar_bikelane_model = load_registry_model(mr, "bikelane_rad_hist_model", latest_version(mr, "bikelane_rad_hist_model"))
 
 # %%
-# Add the predictions to the dataframes
-mag_bikelane_data['mag_cluster'] = mag_bikelane_pred[mag_bikelane_pred.size-1]
-mag_building_data['mag_cluster'] = mag_building_pred[mag_building_pred.size-1]
-rad_bikelane_data['rad_cluster'] = rad_bikelane_pred[rad_bikelane_pred.size-1]
-rad_building_data['rad_cluster'] = rad_building_pred[rad_building_pred.size-1]
+# get the latest version of the radar building model from the model registry
+radar_building_model = load_registry_model(mr, "building_rad_hist_model", latest_version(mr, "building_rad_hist_model"))
 
+# %% [markdown]
+# ## 2. Predicting if theres a detection or not
+# Only the rows after the last scored event time of each model are read and scored
+# (see inference_job.py), the predictions are upserted per row, keyed by the row id.
 
 # %%
-#making a column describing if its data from bikelane or building
-mag_bikelane_data['data_type'] = 'bikelane'
-mag_building_data['data_type'] = 'building'
-rad_bikelane_data['data_type'] = 'bikelane'
-rad_building_data['data_type'] = 'building'
-
-# %%
-#combining the two dataframes
-mag_data = pd.concat([mag_bikelane_data, mag_building_data])
-rad_data = pd.concat([rad_bikelane_data, rad_building_data])
-
-# %%
-# upload the predictions to the feature store as a new feature group
-latest_pred_fg = fs.get_or_create_feature_group(name="mag_parking_predictions",
-                                  version=1,
-                                  primary_key=["x", "y", "z"],
-                                  description="Predictions for parking spots with magnetic data",
-                                  online_enabled=False,
-                                 )
-latest_pred_fg.insert(mag_data)
+# The spot x modality models by name, TRAINING_SPECS has the feature group, parking spot and features of each
+models = {
+    "bikelane_mag_hist_model": mag_bikelane_model,
+    "building_mag_hist_model": mag_building_model,
+    "bikelane_rad_hist_model": radar_bikelane_model,
+    "building_rad_hist_model": radar_building_model,
+}
 
 # %%
-# upload the radar predictions to the feature store as a new feature group
-latest_pred_fg = fs.get_or_create_feature_group(name="rad_parking_predictions",
-                                  version=1,
-                                  primary_key=['radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7'],
-                                  description="Predictions for parking spots with radar data",
-                                  online_enabled=False,
-                                 )
-latest_pred_fg.insert(rad_data)
+# Score the new rows and upload the predictions to the mag_parking_predictions and rad_parking_predictions feature groups
+scored = run_inference(fs, models, TRAINING_SPECS)
+for name, n_rows in scored.items():
+    print(f"{name}: scored {n_rows} new rows")
 
 
+# %% [markdown]
+# ## Predictions for the dashboard
+# The dashboard looks up the status of the latest rows in a prediction store keyed by the row id,
+# so here we score the rows of the new_*_fg feature groups that have no stored prediction yet.
+# Only the rows from the last scored hour of each feature group on are read.
+
+# %%
+# The ids are int64 row keys, the stored ones are kept in a sorted KeyIndex that is saved between runs
+prediction_fg = get_prediction_feature_group(fs)
+prediction_ids_path = key_index_path(PREDICTION_FG_NAME)
+stored_prediction_ids = load_prediction_ids(prediction_fg, prediction_ids_path)
+
+# %%
+dashboard_models = {
+    "BUILDING": (mag_building_model, radar_building_model),
+    "BIKELANE": (mag_bikelane_model, radar_bikelane_model),
+}
+dashboard_scored_until = load_watermarks(DASHBOARD_SCORED_PATH)
+for psensor, (mag_model, rad_model) in dashboard_models.items():
+    name = sensor_feature_group_name(psensor)
+    new_fg = fs.get_feature_group(name=name, version=SENSOR_FG_VERSION)
+    new_data = read_unscored_rows(new_fg, dashboard_scored_until.get(name))
+    if new_data.empty:
+        continue
+    scored_hour = pd.Timestamp(new_data['time_hour'].max()).isoformat()
+    new_data = stored_prediction_ids.new_rows(new_data)
+    if not new_data.empty:
+        prediction_fg.insert(score_rows(new_data, mag_model, rad_model))
+        stored_prediction_ids.add(new_data['id']).save(prediction_ids_path)
+    # The scored hour only moves after the predictions are inserted
+    dashboard_scored_until[name] = scored_hour
+    save_watermarks(dashboard_scored_until, DASHBOARD_SCORED_PATH)
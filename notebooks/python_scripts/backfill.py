@@ -0,0 +1,173 @@
+# Parallel, resumable backfill of historic sensor data.
+# The date range is split into day or week chunks per sensor, the chunks are fetched
+# concurrently over one pooled session and every finished chunk is written as a typed
+# Parquet partition, state/backfill/psensor=<SPOT>/<chunk start>.parquet. The partition
+# file is the checkpoint: a rerun skips the chunks that are already written, so a failed
+# backfill resumes where it stopped. Chunks that reach into the future are fetched again
+# on every run, as more rows can still arrive for them.
+#
+# Usage: python backfill.py 2024-03-01 2024-09-01 [--sensors DEV_EUI,...] [--chunk week] [--workers 4]
+
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+
+from sensor_api import SENSORS, RADAR_RENAMES, SENSOR_SCHEMA, SensorFetchError, API_call_stream, create_session, get_dev_euis
+from sensor_frames import compact_frame
+from time_utils import parse_times
+from watermarks import API_TIME_FORMAT
+
+BACKFILL_PATH = os.getenv(
+    "BACKFILL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "backfill"),
+)
+CHUNK_FREQUENCIES = {"day": pd.Timedelta(days=1), "week": pd.Timedelta(weeks=1)}
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+RETRY_BACKOFF = 2.0
+
+
+def split_range(start, end, chunk="week"):
+    """ The [start, end) range as a list of (chunk start, chunk end) timestamps, the last chunk may be shorter"""
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    step = CHUNK_FREQUENCIES[chunk]
+    chunks = []
+    while start < end:
+        chunks.append((start, min(start + step, end)))
+        start = start + step
+    return chunks
+
+
+def partition_path(psensor, chunk_start, path=BACKFILL_PATH):
+    return os.path.join(path, f"psensor={psensor}", f"{pd.Timestamp(chunk_start):%Y-%m-%dT%H%M%S}.parquet")
+
+
+def empty_chunk():
+    """ A chunk without rows, with the columns and types of a fetched one"""
+    columns = {RADAR_RENAMES.get(column, column): pd.Series(dtype=dtype) for column, dtype in SENSOR_SCHEMA.items()}
+    return pd.DataFrame(columns)
+
+
+def fetch_chunk(dev_eui, chunk_start, chunk_end, session):
+    """ The rows of one sensor and chunk, typed, with the time parsed as timezone naive UTC.
+
+    The API range includes its end second, rows at the chunk end belong to the next chunk.
+    """
+    frames = list(API_call_stream(dev_eui, chunk_start.strftime(API_TIME_FORMAT), chunk_end.strftime(API_TIME_FORMAT),
+                                  session))
+    df = pd.concat(frames, ignore_index=True) if frames else empty_chunk()
+    df['time'] = parse_times(df['time']).dt.tz_localize(None)
+    df = df[(df['time'] >= chunk_start) & (df['time'] < chunk_end)]
+    return compact_frame(df.sort_values(['time', 'f_cnt'], kind='stable', ignore_index=True))
+
+
+def write_partition(df, path):
+    """ Writes a partition atomically, a crash never leaves a half written checkpoint"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+
+def backfill_chunk(dev_eui, chunk_start, chunk_end, session, path=BACKFILL_PATH, max_retries=MAX_RETRIES,
+                   retry_backoff=RETRY_BACKOFF):
+    """ Fetches and writes one chunk, retrying with exponential backoff. Returns the number of rows"""
+    for attempt in range(max_retries + 1):
+        try:
+            df = fetch_chunk(dev_eui, chunk_start, chunk_end, session)
+            break
+        except (SensorFetchError, requests.RequestException):
+            if attempt == max_retries:
+                raise
+            time.sleep(retry_backoff * 2 ** attempt)
+    write_partition(df, partition_path(SENSORS.get(dev_eui, dev_eui), chunk_start, path))
+    return len(df)
+
+
+def pending_chunks(dev_euis, start, end, chunk="week", path=BACKFILL_PATH, now=None):
+    """ The (dev_eui, chunk start, chunk end) tasks without a finished partition"""
+    now = pd.Timestamp(now or pd.Timestamp.now(tz='UTC').tz_localize(None))
+    tasks = []
+    for dev_eui in dev_euis:
+        for chunk_start, chunk_end in split_range(start, end, chunk):
+            finished = chunk_end <= now and os.path.exists(partition_path(SENSORS.get(dev_eui, dev_eui), chunk_start, path))
+            if not finished:
+                tasks.append((dev_eui, chunk_start, chunk_end))
+    return tasks
+
+
+def run_backfill(dev_euis, start, end, chunk="week", max_workers=MAX_WORKERS, path=BACKFILL_PATH, session=None,
+                 now=None):
+    """ Backfills the sensors from start to end (UTC, end excluded), at most max_workers chunks at a time.
+
+    Returns the number of rows per written chunk and a dict of the failed chunks
+    -> error message. Failed chunks are fetched again by the next run.
+    """
+    tasks = pending_chunks(dev_euis, start, end, chunk, path, now)
+    written, failures = {}, {}
+    if not tasks:
+        return written, failures
+
+    own_session = session is None
+    if own_session:
+        session = create_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+            futures = {executor.submit(backfill_chunk, *task, session, path): task for task in tasks}
+            for future in as_completed(futures):
+                dev_eui, chunk_start, _ = futures[future]
+                try:
+                    written[(dev_eui, chunk_start)] = future.result()
+                except (SensorFetchError, requests.RequestException, ValueError) as e:
+                    failures[(dev_eui, chunk_start)] = str(e)
+    finally:
+        if own_session:
+            session.close()
+    return written, failures
+
+
+def report_backfill_failures(failures):
+    """ Prints one line per failed chunk"""
+    for (dev_eui, chunk_start), error in sorted(failures.items()):
+        print(f"Failed chunk {dev_eui} {chunk_start:%Y-%m-%d}: {error}")
+    if failures:
+        print(f"{len(failures)} chunks failed, run the backfill again to resume")
+
+
+def load_backfill(psensors=None, start=None, end=None, path=BACKFILL_PATH):
+    """ Reads the backfilled rows, optionally of some parking spots and a [start, end) UTC time range"""
+    if not glob.glob(os.path.join(path, "psensor=*", "*.parquet")):
+        return empty_chunk().assign(psensor=pd.Series(dtype=str))
+    filters = []
+    if psensors is not None:
+        filters.append(("psensor", "in", list(psensors)))
+    if start is not None:
+        filters.append(("time", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("time", "<", pd.Timestamp(end)))
+    df = pd.read_parquet(path, filters=filters or None)
+    return df.sort_values(['psensor', 'time'], kind='stable', ignore_index=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Backfills historic sensor data in resumable, concurrent chunks")
+    parser.add_argument("start", help="first day, UTC, e.g. 2024-03-01")
+    parser.add_argument("end", help="end of the range, UTC, excluded, e.g. 2024-09-01")
+    parser.add_argument("--sensors", default=None, help="comma separated dev_euis, default: the known sensors")
+    parser.add_argument("--chunk", choices=sorted(CHUNK_FREQUENCIES), default="week")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="chunks fetched at the same time")
+    parser.add_argument("--path", default=BACKFILL_PATH)
+    args = parser.parse_args()
+
+    dev_euis = args.sensors.split(",") if args.sensors else get_dev_euis()
+    started = time.perf_counter()
+    written, failures = run_backfill(dev_euis, args.start, args.end, args.chunk, args.workers, args.path)
+    print(f"Backfilled {sum(written.values())} rows in {len(written)} chunks in {time.perf_counter() - started:.1f} s")
+    report_backfill_failures(failures)
+    if failures:
+        raise SystemExit(1)
@@ -0,0 +1,197 @@
+# Walk-forward backtesting of the detection models.
+# A random train_test_split lets the models train on samples that come after the ones they
+# are tested on. Here every fold trains on a rolling window of days and is tested on the
+# days right after it, the folds run in parallel in a process pool. The history of each
+# spec is cached as Parquet with the fold bounds, so re-running with other detector
+# variants does not read the feature store again.
+#
+# Usage: python backtest.py [--train-days 14] [--test-days 3] [--variants knn_k2 prototypes_256] [--fold-plots]
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from sklearn.metrics import accuracy_score, confusion_matrix
+from sklearn.neighbors import KNeighborsClassifier
+
+from detector_engine import PrototypeDetector
+from training_engine import TRAINING_SPECS, save_confusion_matrix
+
+BACKTEST_PATH = os.getenv(
+    "BACKTEST_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "backtest"),
+)
+TRAIN_DAYS = 14
+TEST_DAYS = 3
+# Folds with fewer training rows are skipped
+MIN_TRAIN_ROWS = 50
+
+CLASSES = ["detection", "no_detection"]
+
+# Detector variants that can be compared, name -> unfitted model
+VARIANTS = {
+    "knn_k2": KNeighborsClassifier(n_neighbors=2),
+    "knn_k5_distance": KNeighborsClassifier(n_neighbors=5, weights="distance"),
+    "prototypes_64": PrototypeDetector(n_prototypes=64),
+    "prototypes_256": PrototypeDetector(n_prototypes=256),
+}
+
+
+def walk_forward_folds(start, end, train_days=TRAIN_DAYS, test_days=TEST_DAYS):
+    """ Rolling folds between start and end: train on train_days, test on the next test_days, then step test_days"""
+    start = pd.Timestamp(start).floor("D")
+    train_window, test_window = pd.Timedelta(days=train_days), pd.Timedelta(days=test_days)
+    folds = []
+    test_start = start + train_window
+    while test_start < pd.Timestamp(end):
+        folds.append({"fold": len(folds),
+                      "train_start": test_start - train_window, "train_end": test_start,
+                      "test_start": test_start, "test_end": test_start + test_window})
+        test_start += test_window
+    return folds
+
+
+def read_history(fs, spec):
+    """ The features, label and event time of a spec's parking spot, sorted by time"""
+    fg = fs.get_feature_group(spec["feature_group"], version=spec["feature_group_version"])
+    df = fg.select(spec["features"] + [spec["label"], "time"]) \
+        .filter(fg["psensor"] == spec["psensor"]).read(read_options={"use_hive": True})
+    df["time"] = pd.to_datetime(df["time"])
+    if getattr(df["time"].dt, "tz", None) is not None:
+        df["time"] = df["time"].dt.tz_convert("UTC").dt.tz_localize(None)
+    return df.sort_values("time", ignore_index=True)
+
+
+def cache_key(spec, train_days, test_days, start=None, end=None):
+    key = json.dumps([spec["name"], spec["feature_group"], spec["feature_group_version"], spec["psensor"],
+                      spec["features"], spec["label"], train_days, test_days, str(start), str(end)])
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def prepare_folds(fs, spec, train_days=TRAIN_DAYS, test_days=TEST_DAYS, start=None, end=None,
+                  cache_path=BACKTEST_PATH, refresh=False):
+    """ Returns the cache folder of a spec with history.parquet and the folds in manifest.json.
+
+    The feature store is only read if the folder does not exist yet or refresh is set.
+    """
+    path = os.path.join(cache_path, f"{spec['name']}_{cache_key(spec, train_days, test_days, start, end)}")
+    manifest_path = os.path.join(path, "manifest.json")
+    if os.path.exists(manifest_path) and not refresh:
+        return path
+
+    df = read_history(fs, spec)
+    if start is not None:
+        df = df[df["time"] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df["time"] < pd.Timestamp(end)]
+    folds = walk_forward_folds(df["time"].min(), df["time"].max(), train_days, test_days) if not df.empty else []
+
+    os.makedirs(path, exist_ok=True)
+    df.to_parquet(os.path.join(path, "history.parquet"), index=False)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump({"spec": spec["name"], "rows": len(df), "folds": folds}, f, indent=1, default=str)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return path
+
+
+def load_folds(path):
+    with open(os.path.join(path, "manifest.json")) as f:
+        folds = json.load(f)["folds"]
+    for fold in folds:
+        for key in ["train_start", "train_end", "test_start", "test_end"]:
+            fold[key] = pd.Timestamp(fold[key])
+    return folds
+
+
+def read_window(path, start, end):
+    """ The cached rows with start <= time < end, filtered while reading the Parquet file"""
+    return pd.read_parquet(os.path.join(path, "history.parquet"),
+                           filters=[("time", ">=", start), ("time", "<", end)])
+
+
+def evaluate_fold(spec, path, fold, variants, min_train_rows=MIN_TRAIN_ROWS):
+    """ Fits every variant on the fold's training window and scores it on the test window.
+
+    Rows without a label are left out of both windows.
+    """
+    train = read_window(path, fold["train_start"], fold["train_end"]).dropna(subset=[spec["label"]])
+    test = read_window(path, fold["test_start"], fold["test_end"]).dropna(subset=[spec["label"]])
+    if len(train) < min_train_rows or test.empty:
+        return []
+    rows = []
+    for name, variant in variants.items():
+        model = copy.deepcopy(variant).fit(train[spec["features"]], train[spec["label"]].values)
+        y_pred = model.predict(test[spec["features"]])
+        rows.append({
+            "model": spec["name"], "variant": name, **fold,
+            "n_train": len(train), "n_test": len(test),
+            "accuracy": accuracy_score(test[spec["label"]].values, y_pred),
+            "confusion_matrix": confusion_matrix(test[spec["label"]].values, y_pred, labels=CLASSES).tolist(),
+            "classes": CLASSES,
+        })
+    return rows
+
+
+def backtest(fs, specs=TRAINING_SPECS, variants=None, train_days=TRAIN_DAYS, test_days=TEST_DAYS,
+             start=None, end=None, max_workers=None, cache_path=BACKTEST_PATH, refresh=False):
+    """ Walk-forward evaluation of the variants on every spec, one row per spec x fold x variant"""
+    variants = variants or {"knn_k2": VARIANTS["knn_k2"]}
+    tasks = []
+    for spec in specs:
+        path = prepare_folds(fs, spec, train_days, test_days, start, end, cache_path, refresh)
+        tasks += [(spec, path, fold, variants) for fold in load_folds(path)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(evaluate_fold, *zip(*tasks))) if tasks else []
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+def summarize(results):
+    """ Accuracy over the folds per model and variant"""
+    return results.groupby(["model", "variant"])["accuracy"].agg(["count", "mean", "std", "min", "max"])
+
+
+def save_results(results, output_dir, specs=TRAINING_SPECS, fold_plots=False):
+    """ Writes results.json and confusion matrices named like the pictures/knn_*_confusion_matrix.png plots:
+    the sum over the folds per variant, and with fold_plots one plot per fold.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results.to_json(os.path.join(output_dir, "results.json"), orient="records", date_format="iso", indent=1)
+    matrix_names = {spec["name"]: spec["matrix"] for spec in specs}
+    for (model, variant), group in results.groupby(["model", "variant"]):
+        total = sum(pd.DataFrame(m).values for m in group["confusion_matrix"])
+        save_confusion_matrix({"confusion_matrix": total, "classes": CLASSES},
+                              os.path.join(output_dir, f"backtest_{variant}_{matrix_names[model]}"))
+        if fold_plots:
+            for _, row in group.iterrows():
+                save_confusion_matrix(row, os.path.join(output_dir, f"fold{row['fold']:02d}_{variant}_{matrix_names[model]}"))
+
+
+if __name__ == "__main__":
+    from local_feature_store import get_feature_store
+
+    parser = argparse.ArgumentParser(description="Walk-forward backtest of the detection models")
+    parser.add_argument("--train-days", type=int, default=TRAIN_DAYS)
+    parser.add_argument("--test-days", type=int, default=TEST_DAYS)
+    parser.add_argument("--start", default=None, help="First day of history to use, e.g. 2024-03-01")
+    parser.add_argument("--end", default=None, help="Day after the last day of history to use")
+    parser.add_argument("--variants", nargs="+", default=["knn_k2"], choices=sorted(VARIANTS))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output-dir", default=os.path.join(BACKTEST_PATH, "results"))
+    parser.add_argument("--fold-plots", action="store_true", help="Also saves a confusion matrix per fold")
+    parser.add_argument("--refresh", action="store_true", help="Reads the feature store again instead of the cache")
+    args = parser.parse_args()
+
+    results = backtest(get_feature_store(), variants={name: VARIANTS[name] for name in args.variants},
+                       train_days=args.train_days, test_days=args.test_days, start=args.start, end=args.end,
+                       max_workers=args.workers, refresh=args.refresh)
+    if results.empty:
+        print("No folds, the history is shorter than one training window")
+    else:
+        print(results[["model", "variant", "fold", "test_start", "n_train", "n_test", "accuracy"]].to_string(index=False))
+        print(summarize(results))
+        save_results(results, args.output_dir, fold_plots=args.fold_plots)
+        print(f"Results written to {args.output_dir}")
@@ -0,0 +1,75 @@
+# Incremental data for the Streamlit dashboard.
+# Keeps the last 24 hours of a feature group in memory and only fetches the rows
+# from shortly before the last one it has seen, deduplicated by id. Rows can land with
+# older event times (the write-behind buffer, backfills, replays), so the fetch overlaps
+# the last `lateness` and the whole window is read again every `full_refresh_seconds`.
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+LATENESS = timedelta(minutes=float(os.getenv("DASHBOARD_LATENESS_MINUTES", 60)))
+FULL_REFRESH_SECONDS = float(os.getenv("DASHBOARD_FULL_REFRESH_SECONDS", 900))
+
+
+class SlidingWindow(object):
+
+    def __init__(self, feature_group, window=timedelta(hours=24), time_column='time', min_refresh_seconds=60,
+                 lateness=LATENESS, full_refresh_seconds=FULL_REFRESH_SECONDS):
+        """ A sliding window over a feature group with an event time column"""
+        self.feature_group = feature_group
+        self.window = window
+        self.time_column = time_column
+        self.min_refresh_seconds = min_refresh_seconds
+        self.lateness = lateness
+        self.full_refresh_seconds = full_refresh_seconds
+        self.data = None
+        self.last_seen = None
+        self.last_refresh = 0.0
+        self.last_full_refresh = 0.0
+        self.lock = threading.Lock()
+
+    def _read_after(self, start, inclusive):
+        """ Reads the rows after start, with the filter pushed down to the feature store"""
+        feature = self.feature_group[self.time_column]
+        condition = feature >= start if inclusive else feature > start
+        df = self.feature_group.select_all().filter(condition).read(read_options={"use_hive": True})
+        df[self.time_column] = pd.to_datetime(df[self.time_column])
+        # Feature stores may return the event time timezone aware, the dashboard works in naive local time
+        if getattr(df[self.time_column].dt, "tz", None) is not None:
+            df[self.time_column] = df[self.time_column].dt.tz_localize(None)
+        return df
+
+    def refresh(self, now=None, force=False):
+        """ Fetches the new rows, evicts the rows older than the window and returns a copy of the window.
+
+        The rows from lateness before the last seen row on are fetched again, rows with
+        an id that is already in the window replace the old version. Without force, the
+        feature store is asked at most every min_refresh_seconds.
+        """
+        now = now or datetime.now()
+        with self.lock:
+            full = self.data is None or time.monotonic() - self.last_full_refresh >= self.full_refresh_seconds
+            if full:
+                # The whole window, for rows that landed with event times before the overlap
+                self.data = self._read_after(now - self.window, inclusive=True)
+                self.last_refresh = self.last_full_refresh = time.monotonic()
+            elif force or time.monotonic() - self.last_refresh >= self.min_refresh_seconds:
+                start = now - self.window if self.last_seen is None else max(self.last_seen - self.lateness,
+                                                                             now - self.window)
+                new = self._read_after(start, inclusive=True)
+                if not new.empty:
+                    self.data = pd.concat([self.data, new], ignore_index=True)
+                    if 'id' in self.data.columns:
+                        self.data = self.data.drop_duplicates(subset='id', keep='last')
+                self.last_refresh = time.monotonic()
+
+            # Evicting the rows that slid out of the window
+            self.data = self.data[self.data[self.time_column] >= now - self.window]
+            self.data = self.data.sort_values(self.time_column, ignore_index=True)
+            if not self.data.empty:
+                self.last_seen = self.data[self.time_column].max()
+            return self.data.copy()
@@ -0,0 +1,173 @@
+# Local cache of training datasets.
+# A dataset is addressed by a hash of the feature view name, version, query and time range,
+# and stored as Parquet parts in state/datasets/<hash>/. The manifest remembers up to which
+# event time the data was fetched. The next use fetches the rows from a lookback window
+# before that on and appends them as a new part, the parts are deduplicated on the row id,
+# keeping the last fetched copy, so rows that landed late or were upserted in the window are
+# refreshed. Rows can also land with event times far in the past (backfills, relabelling),
+# so after DATASET_CACHE_MAX_AGE_DAYS the whole range is fetched again.
+#
+# Usage: python dataset_cache.py [--refresh]   (fills or updates the cache for the hist_*_fv feature views)
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+
+DATASET_CACHE_PATH = os.getenv(
+    "DATASET_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "datasets"),
+)
+MANIFEST = "manifest.json"
+# Every update fetches this far before the last fetched event time again
+LOOKBACK = pd.Timedelta(hours=float(os.getenv("DATASET_CACHE_LOOKBACK_HOURS", 72)))
+# After this long since the last full fetch the whole time range is fetched again
+MAX_AGE = pd.Timedelta(days=float(os.getenv("DATASET_CACHE_MAX_AGE_DAYS", 7)))
+
+
+def _as_time(value):
+    return pd.Timestamp(value).to_pydatetime() if value is not None else None
+
+
+def _as_text(value):
+    return pd.Timestamp(value).isoformat() if value is not None else None
+
+
+def query_text(feature_view):
+    """ The query of a feature view as text, for hsfs and local feature views"""
+    query = getattr(feature_view, "query", None)
+    if query is not None and hasattr(query, "to_string"):
+        return query.to_string()
+    return repr(query)
+
+
+def dataset_key(feature_view, start_time=None, end_time=None):
+    """ Content address of a dataset: hash of feature view name, version, query and time range"""
+    definition = json.dumps([feature_view.name, feature_view.version, query_text(feature_view),
+                             _as_text(start_time), _as_text(end_time)])
+    return hashlib.sha1(definition.encode()).hexdigest()
+
+
+class DatasetCache(object):
+
+    def __init__(self, path=DATASET_CACHE_PATH, key_column="id", time_column="time", lookback=LOOKBACK,
+                 max_age=MAX_AGE):
+        """ The parts are fetched with the primary key and event time of the feature groups,
+        key_column and time_column, which are not part of the returned features
+        """
+        self.path = path
+        self.key_column = key_column
+        self.time_column = time_column
+        self.lookback = lookback
+        self.max_age = max_age
+
+    def _dir(self, key):
+        return os.path.join(self.path, key)
+
+    def _load_manifest(self, key):
+        manifest_path = os.path.join(self._dir(key), MANIFEST)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def _save_manifest(self, key, manifest):
+        manifest_path = os.path.join(self._dir(key), MANIFEST)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def update(self, feature_view, start_time=None, end_time=None, now=None, refresh=False):
+        """ Fetches the rows of the time range that may have changed. Returns the number of fetched rows.
+
+        Rows are fetched from the lookback window before the last fetch up to now (or
+        end_time if it is earlier). With refresh, or when the last full fetch is older
+        than max_age, the whole time range is fetched again and replaces the parts.
+        """
+        key = dataset_key(feature_view, start_time, end_time)
+        manifest = self._load_manifest(key)
+        if manifest is None:
+            manifest = {"feature_view": feature_view.name, "version": feature_view.version,
+                        "query": query_text(feature_view), "start_time": _as_text(start_time),
+                        "end_time": _as_text(end_time), "fetched_until": None, "parts": [], "rows": 0}
+
+        now = _as_time(now or datetime.now())
+        fetch_end = now if end_time is None else min(_as_time(end_time), now)
+        full_fetch_at = _as_time(manifest.get("full_fetch_at"))
+        full = refresh or full_fetch_at is None or now - full_fetch_at > self.max_age
+        old_parts = manifest["parts"] if full else []
+        if full:
+            fetch_start = _as_time(start_time)
+            manifest["parts"], manifest["rows"] = [], 0
+        else:
+            fetch_start = _as_time(pd.Timestamp(manifest["fetched_until"]) - self.lookback)
+            if start_time is not None:
+                fetch_start = max(fetch_start, _as_time(start_time))
+        if fetch_start is not None and fetch_start >= fetch_end:
+            return 0
+
+        X, y = feature_view.training_data(start_time=fetch_start, end_time=fetch_end, primary_key=True,
+                                          event_time=True)
+        df = pd.concat([X.reset_index(drop=True), y.reset_index(drop=True)], axis=1)
+        os.makedirs(self._dir(key), exist_ok=True)
+        if not df.empty:
+            part = f"part-{manifest.get('next_part', len(manifest['parts'])):05d}.parquet"
+            df.to_parquet(os.path.join(self._dir(key), part), index=False)
+            manifest["parts"].append(part)
+            manifest["next_part"] = int(part[len("part-"):-len(".parquet")]) + 1
+            manifest["rows"] += len(df)
+        if not manifest.get("features"):
+            manifest["features"] = [c for c in X.columns if c not in (self.key_column, self.time_column)]
+            manifest["labels"] = list(y.columns)
+        manifest["fetched_until"] = _as_text(fetch_end)
+        if full:
+            manifest["full_fetch_at"] = _as_text(now)
+        # The manifest is written last, a crash before it only leaves an unlisted part behind
+        self._save_manifest(key, manifest)
+        for part in old_parts:
+            os.remove(os.path.join(self._dir(key), part))
+        return len(df)
+
+    def get(self, feature_view, start_time=None, end_time=None, update=True, now=None):
+        """ Returns X, y of a feature view and time range from the cache, after fetching the new rows.
+
+        A row fetched more than once is returned once, in its last fetched version.
+        """
+        if update:
+            self.update(feature_view, start_time, end_time, now)
+        key = dataset_key(feature_view, start_time, end_time)
+        manifest = self._load_manifest(key)
+        if manifest is None:
+            raise KeyError(f"No cached dataset for {feature_view.name} version {feature_view.version}")
+        if manifest["parts"]:
+            df = pd.concat([pd.read_parquet(os.path.join(self._dir(key), part)) for part in manifest["parts"]],
+                           ignore_index=True)
+            if self.key_column in df.columns:
+                df = df.drop_duplicates(subset=[self.key_column], keep="last", ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=manifest["features"] + manifest["labels"])
+        return df[manifest["features"]], df[manifest["labels"]]
+
+    def train_test_split(self, feature_view, test_size, start_time=None, end_time=None, random_state=None, update=True):
+        """ Returns X_train, X_test, y_train, y_test like feature_view.train_test_split, from the cache"""
+        from sklearn.model_selection import train_test_split
+
+        X, y = self.get(feature_view, start_time, end_time, update)
+        return train_test_split(X, y, test_size=test_size, random_state=random_state)
+
+
+if __name__ == "__main__":
+    import sys
+
+    from local_feature_store import get_feature_store
+    from training_engine import TRAINING_SPECS
+
+    refresh = "--refresh" in sys.argv[1:]
+    fs = get_feature_store()
+    cache = DatasetCache()
+    for spec in TRAINING_SPECS:
+        feature_view = fs.get_feature_view(spec["feature_view"], version=spec["version"])
+        fetched = cache.update(feature_view, refresh=refresh)
+        print(f"{spec['feature_view']}: fetched {fetched} rows, {dataset_key(feature_view)[:12]}")
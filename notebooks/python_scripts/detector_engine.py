@@ -0,0 +1,115 @@
+# Scalable nearest-neighbour detector.
+# Instead of keeping every training row like KNeighborsClassifier(n_neighbors=2) on the
+# full history, the training set of each class is condensed to a fixed number of
+# prototypes (k-means centroids), which are indexed with a KD or ball tree. Model size
+# and prediction time then stay flat as months of sensor data accumulate.
+#
+# Usage: python detector_engine.py   (compares prototype sizes on the hist_*_fv feature views)
+
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics import accuracy_score
+from sklearn.neighbors import KNeighborsClassifier
+
+# The detectors we train, feature view name -> label
+DETECTOR_VIEWS = {
+    "hist_building_mag_fv": "mag_cluster",
+    "hist_bikelane_mag_fv": "mag_cluster",
+    "hist_building_radar_fv": "radar_cluster",
+    "hist_bikelane_radar_fv": "radar_cluster",
+}
+
+
+def condense_prototypes(X, y, n_prototypes=256, random_state=0):
+    """ Condenses every class to at most n_prototypes k-means centroids.
+
+    Classes with fewer rows than n_prototypes are kept as they are.
+    Returns the prototype points and their labels.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y).ravel()
+    points, labels = [], []
+    for label in np.unique(y):
+        class_X = X[y == label]
+        if len(class_X) > n_prototypes:
+            kmeans = MiniBatchKMeans(n_clusters=n_prototypes, random_state=random_state,
+                                     batch_size=max(1024, 4 * n_prototypes), n_init=3)
+            class_X = kmeans.fit(class_X).cluster_centers_
+        points.append(class_X)
+        labels.append(np.full(len(class_X), label, dtype=y.dtype))
+    return np.vstack(points), np.concatenate(labels)
+
+
+class PrototypeDetector(object):
+
+    def __init__(self, n_prototypes=256, n_neighbors=2, weights="uniform", algorithm="kd_tree", random_state=0):
+        """ KNN on condensed prototypes, algorithm is the sklearn index: kd_tree, ball_tree or brute"""
+        self.n_prototypes = n_prototypes
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.algorithm = algorithm
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        feature_names = list(X.columns) if hasattr(X, "columns") else None
+        points, labels = condense_prototypes(X, y, self.n_prototypes, self.random_state)
+        if feature_names is not None:
+            points = pd.DataFrame(points, columns=feature_names)
+        # The fitted KNN is a normal sklearn model, so it can be saved and loaded like the current ones
+        self.knn_ = KNeighborsClassifier(n_neighbors=self.n_neighbors, weights=self.weights,
+                                         algorithm=self.algorithm).fit(points, labels)
+        self.classes_ = self.knn_.classes_
+        return self
+
+    def predict(self, X):
+        return self.knn_.predict(X)
+
+    def to_knn(self):
+        """ The fitted KNeighborsClassifier, e.g. for joblib.dump or model_artifacts.save_knn_artifact"""
+        return self.knn_
+
+
+def model_size(model):
+    """ Bytes held by the fitted points of a KNN model"""
+    knn = model.to_knn() if hasattr(model, "to_knn") else model
+    return knn._fit_X.nbytes + np.asarray(knn._y).nbytes
+
+
+def evaluate(model, X_test, y_test, repeat=3):
+    """ Accuracy, model size and the batch prediction time per row of a fitted model"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        y_pred = model.predict(X_test)
+        best = min(best, time.perf_counter() - start)
+    return {
+        "accuracy": accuracy_score(np.asarray(y_test).ravel(), y_pred),
+        "size_bytes": model_size(model),
+        "predict_us_per_row": best / max(1, len(X_test)) * 1e6,
+    }
+
+
+def compare_detectors(X_train, X_test, y_train, y_test, prototype_sizes=(64, 256, 1024), algorithm="kd_tree"):
+    """ Reports the accuracy trade-off of prototype detectors against the current full KNN model"""
+    y_train = np.asarray(y_train).ravel()
+    rows = [{"model": "knn_full (current)", **evaluate(KNeighborsClassifier(n_neighbors=2).fit(X_train, y_train), X_test, y_test)}]
+    for n_prototypes in prototype_sizes:
+        detector = PrototypeDetector(n_prototypes=n_prototypes, algorithm=algorithm).fit(X_train, y_train)
+        rows.append({"model": f"prototypes_{n_prototypes}", **evaluate(detector, X_test, y_test)})
+    report = pd.DataFrame(rows).set_index("model")
+    report["accuracy_delta"] = report["accuracy"] - report.loc["knn_full (current)", "accuracy"]
+    return report
+
+
+if __name__ == "__main__":
+    from local_feature_store import get_feature_store
+
+    fs = get_feature_store()
+    for view_name in DETECTOR_VIEWS:
+        feature_view = fs.get_feature_view(view_name, version=1)
+        X_train, X_test, y_train, y_test = feature_view.train_test_split(0.2)
+        print(view_name)
+        print(compare_detectors(X_train, X_test, y_train, y_test))
@@ -0,0 +1,142 @@
+# Single-row inference fast path for the KNN detection models.
+# sklearn's predict validates the input, handles DataFrames and sets up a tree query on
+# every call, which costs far more than the work for one row. FastKNN reads the fitted
+# points once, precomputes their squared norms and answers one feature vector with a
+# matrix-vector product and an argpartition, without any per-call validation.
+#
+# Usage: python fast_path.py ../models/building_mag_hist_model.pkl   (latency benchmark)
+
+import time
+
+import numpy as np
+
+# Upper bounds of the latency histogram buckets in microseconds, the last bucket is open
+LATENCY_BUCKETS_US = [5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000]
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets_us=LATENCY_BUCKETS_US):
+        """ Counts latencies per bucket, recording is a bisect and an increment"""
+        self.bounds_ns = np.array(buckets_us, dtype=np.int64) * 1000
+        self.buckets_us = list(buckets_us)
+        self.counts = np.zeros(len(buckets_us) + 1, dtype=np.int64)
+        self.total_ns = 0
+
+    def record(self, elapsed_ns):
+        self.counts[np.searchsorted(self.bounds_ns, elapsed_ns)] += 1
+        self.total_ns += elapsed_ns
+
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        """ Upper bound in µs of the bucket holding the q-th percentile, inf for the open bucket"""
+        n = self.count()
+        if n == 0:
+            return float("nan")
+        index = int(np.searchsorted(np.cumsum(self.counts), q / 100 * n))
+        return float(self.buckets_us[index]) if index < len(self.buckets_us) else float("inf")
+
+    def summary(self):
+        n = self.count()
+        labels = [f"<={b}us" for b in self.buckets_us] + [f">{self.buckets_us[-1]}us"]
+        return {
+            "count": n,
+            "mean_us": self.total_ns / n / 1000 if n else float("nan"),
+            "p50_us": self.percentile(50),
+            "p99_us": self.percentile(99),
+            "buckets": dict(zip(labels, self.counts.tolist())),
+        }
+
+
+class FastKNN(object):
+
+    def __init__(self, model, record_latency=True):
+        """ Precomputes the internals of a fitted euclidean KNN model (sklearn or model_artifacts.MmapKNN).
+
+        predict_one expects a float vector in the order of feature_names and does no checks.
+        """
+        self.fit_X = np.ascontiguousarray(model._fit_X, dtype=np.float64)
+        self.fit_sq = np.einsum("ij,ij->i", self.fit_X, self.fit_X)
+        self.y = np.asarray(model._y, dtype=np.int64)
+        self.classes = np.asarray(model.classes_)
+        self.n_classes = len(self.classes)
+        self.k = int(model.n_neighbors)
+        self.distance_weights = model.weights == "distance"
+        names = getattr(model, "feature_names_in_", None)
+        self.feature_names = list(names) if names is not None else None
+        self.histogram = LatencyHistogram() if record_latency else None
+
+    def vector(self, row):
+        """ A feature vector from a mapping (dict, Series) in the training order"""
+        return np.array([row[name] for name in self.feature_names], dtype=np.float64)
+
+    def _predict(self, x):
+        # |a - x|^2 = |a|^2 - 2 a.x + |x|^2, the last term does not change the order
+        d = self.fit_sq - 2.0 * (self.fit_X @ x)
+        nearest = np.argpartition(d, self.k - 1)[:self.k]
+        if self.distance_weights:
+            distances = np.sqrt(np.maximum(d[nearest] + x @ x, 0.0))
+            if (distances == 0).any():
+                weights = (distances == 0).astype(np.float64)
+            else:
+                weights = 1.0 / distances
+        else:
+            weights = None
+        # Ties go to the first class, like in sklearn
+        return self.classes[np.bincount(self.y[nearest], weights, minlength=self.n_classes).argmax()]
+
+    def predict_one(self, x):
+        """ Label of one feature vector"""
+        if self.histogram is None:
+            return self._predict(x)
+        start = time.perf_counter_ns()
+        label = self._predict(x)
+        self.histogram.record(time.perf_counter_ns() - start)
+        return label
+
+    def predict_indices(self, X):
+        """ Class indices for a batch of feature vectors, one matrix product for the whole batch"""
+        d = self.fit_sq[None, :] - 2.0 * (X @ self.fit_X.T)
+        nearest = np.argpartition(d, self.k - 1, axis=1)[:, :self.k]
+        if self.distance_weights:
+            x_sq = np.einsum("ij,ij->i", X, X)[:, None]
+            distances = np.sqrt(np.maximum(np.take_along_axis(d, nearest, axis=1) + x_sq, 0.0))
+            exact = distances == 0
+            with np.errstate(divide="ignore"):
+                weights = np.where(exact.any(axis=1, keepdims=True), exact, 1.0 / distances)
+        else:
+            weights = np.ones(nearest.shape)
+        votes = np.zeros((len(X), self.n_classes))
+        np.add.at(votes, (np.arange(len(X))[:, None], self.y[nearest]), weights)
+        return votes.argmax(axis=1)
+
+    def predict_batch(self, X):
+        return self.classes[self.predict_indices(X)]
+
+    def latency_summary(self):
+        return self.histogram.summary() if self.histogram is not None else None
+
+
+if __name__ == "__main__":
+    import sys
+
+    from model_artifacts import load_model
+
+    for path in sys.argv[1:]:
+        model = load_model(path)
+        fast = FastKNN(model)
+        X = np.array(model._fit_X[:2000], dtype=np.float64)
+        labels = [fast.predict_one(x) for x in X]
+        agreement = np.mean(np.array(labels) == model.predict(X))
+
+        start = time.perf_counter()
+        for x in X:
+            model.predict(x.reshape(1, -1))
+        sklearn_us = (time.perf_counter() - start) / len(X) * 1e6
+
+        print(path)
+        print(f"  agreement with model.predict: {agreement:.4f}")
+        print(f"  model.predict per row: {sklearn_us:.1f}us")
+        print(f"  fast path: {fast.latency_summary()}")
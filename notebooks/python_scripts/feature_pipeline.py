@@ -0,0 +1,226 @@
+# The steps of the latest API feature pipeline as functions.
+# Used by 2_latest_api_feature_pipeline.py for a single run and by
+# ingestion_service.py, which keeps everything loaded between cycles.
+
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from sinks import HopsworksSink, WriteBehindBuffer
+from sensor_api import MAX_CALL_RANGE, SENSORS, get_dev_euis, get_location, fetch_sensor_ranges, report_failures
+from sensor_frames import compact_frame, add_empty_labels, storage_frame
+from row_keys import KEY_INDEX_PATH, KeyIndex, key_index_path, row_keys
+from time_utils import normalize_time
+from watermarks import API_TIME_FORMAT, WATERMARK_PATH, save_watermarks, get_from_date, new_rows, find_fcnt_gaps, advance_watermark
+
+# Version 3 of the new_<spot>_fg feature groups adds the rolling features of rolling_features.py
+# and packs UTC times in the keys, version 2 is keyed by the int64 row keys of row_keys.py (local
+# time), version 1 by the `time_psensor` strings. The pipelines, the inference and the app all
+# read and write this version. Before version 3 is used, migrate_sensor_fg.py copies the rows of
+# version 2 over. Until then SENSOR_FG_VERSION=2 keeps everything on the old groups.
+SENSOR_FG_VERSION = int(os.getenv("SENSOR_FG_VERSION", 3))
+
+
+def get_default_range(now=None):
+    """ The yesterday -> tomorrow window used for sensors without a watermark"""
+    now = now or datetime.now()
+    yesterday = now - timedelta(days=1)
+    tomorrow = now + timedelta(days=1)
+    return yesterday.strftime(API_TIME_FORMAT), tomorrow.strftime(API_TIME_FORMAT)
+
+
+def limit_range(from_date, to_date, max_range=MAX_CALL_RANGE):
+    """ The end of the first window of at most max_range from from_date, to_date if it is earlier"""
+    return min(pd.Timestamp(to_date), pd.Timestamp(from_date) + max_range).strftime(API_TIME_FORMAT)
+
+
+def fetch_new_rows(dev_euis, watermarks, session=None, now=None):
+    """ Fetches every sensor from its own watermark and keeps only the rows after it.
+
+    A sensor whose watermark is further back than MAX_CALL_RANGE is fetched one
+    window at a time, up to the first window with new rows. The watermark then
+    catches up over the next runs without holding the whole range in memory.
+    Returns a dict of dev_eui -> new rows (sensors without new rows are left out)
+    and a dict of dev_eui -> error message for the sensors that failed.
+    """
+    formatted_yesterday, formatted_tomorrow = get_default_range(now)
+    pending = {dev_eui: get_from_date(watermarks.get(dev_eui), formatted_yesterday) for dev_eui in dev_euis}
+
+    sensor_new_rows, failed_sensors = {}, {}
+    while pending:
+        sensor_ranges = {dev_eui: (from_date, limit_range(from_date, formatted_tomorrow))
+                         for dev_eui, from_date in pending.items()}
+        sensor_data_from_api, failures = fetch_sensor_ranges(sensor_ranges, session)
+        failed_sensors.update(failures)
+
+        pending = {}
+        for dev_eui, df in sensor_data_from_api.items():
+            df = new_rows(df, watermarks.get(dev_eui))
+            if not df.empty:
+                sensor_new_rows[dev_eui] = df
+            elif sensor_ranges[dev_eui][1] != formatted_tomorrow:
+                pending[dev_eui] = sensor_ranges[dev_eui][1]
+    return sensor_new_rows, failed_sensors
+
+
+def report_fcnt_gaps(sensor_new_rows, watermarks):
+    """ Prints the frame counter gaps so lost uplinks between runs are visible"""
+    for dev_eui, df in sensor_new_rows.items():
+        gaps = find_fcnt_gaps(df, watermarks.get(dev_eui))
+        if not gaps.empty:
+            print(f"Sensor {dev_eui} lost {gaps['missing'].sum()} uplinks in {len(gaps)} gaps")
+            print(gaps)
+
+
+# Create a unique identifier for each row in the datasets
+def create_id(df, psensor):
+    # Assign the sensor prefix based on the parking spot name
+    if not psensor:
+        raise ValueError("Unknown dataset name provided")
+    df['psensor'] = psensor
+
+    # Create a new column 'id' with the parking spot, time and f_cnt packed into an int64
+    df['id'] = row_keys(df)
+
+    return df
+
+
+def prepare_sensor_frames(sensor_new_rows, weather_store, feature_engine=None):
+    """ Preprocessing and feature engineering of the new rows, keyed by parking spot name.
+
+    Normalizes the time, joins the weather from the weather store, creates the ids
+    and the empty label columns. The radar names are already applied when the API
+    response is parsed, the frames are kept in the compact dtypes of sensor_frames.py.
+    With a feature_engine (see rolling_features.py) the rolling features are added,
+    its new state is only kept after feature_engine.commit().
+    """
+    # One copy, the new rows are still needed afterwards to advance the watermarks
+    sensor_frames = {SENSORS.get(dev_eui, dev_eui): compact_frame(df.copy()) for dev_eui, df in sensor_new_rows.items()}
+    if not sensor_frames:
+        return sensor_frames
+    sensor_locations = {SENSORS.get(dev_eui, dev_eui): get_location(dev_eui) for dev_eui in sensor_new_rows}
+
+    # Parsing the time column, converting it to Danish local time and creating a
+    # time_hour column in UTC floored to the hour to merge with weather data
+    for df in sensor_frames.values():
+        normalize_time(df)
+
+    # Only the hours that are not in the weather store yet are downloaded
+    weather_start = min(df['time_hour'].min() for df in sensor_frames.values())
+    weather_end = max(df['time_hour'].max() for df in sensor_frames.values())
+    weather_store.fill(sensor_locations.values(), weather_start, weather_end)
+
+    # Attaching the weather of each row's hour to all parking spots in one as-of join,
+    # rows whose hour is missing in the store get the nearest stored hour
+    sensor_frames = weather_store.join(sensor_frames, sensor_locations)
+
+    for psensor, df in sensor_frames.items():
+        df = compact_frame(create_id(df, psensor))
+
+        #making the empty (null) label columns
+        add_empty_labels(df)
+        if feature_engine is not None:
+            df = feature_engine.transform(psensor, df)
+        sensor_frames[psensor] = df
+
+    return sensor_frames
+
+
+def sensor_feature_group_name(psensor):
+    """ The feature group with the latest data of a parking spot, e.g. new_building_fg"""
+    return f"new_{psensor.lower()}_fg"
+
+
+def get_sensor_feature_group(fs, name, version=SENSOR_FG_VERSION):
+    """ Gets or creates a new_<spot>_fg feature group by name"""
+    spot = name[len("new_"):-len("_fg")]
+    return fs.get_or_create_feature_group(name=name,
+                                      version=version,
+                                      primary_key=["id"],
+                                      event_time='time',
+                                      description=f"New {spot} data",
+                                      online_enabled=True,
+                                     )
+
+
+def create_write_buffer(fs, **kwargs):
+    """ A write-behind buffer in front of the new_<spot>_fg feature groups, see sinks.py"""
+    return WriteBehindBuffer(HopsworksSink(lambda name: get_sensor_feature_group(fs, name)), **kwargs)
+
+
+def sensor_key_index_path(name, version=SENSOR_FG_VERSION, path=KEY_INDEX_PATH):
+    """ The key index of a version of a new_<spot>_fg feature group, version 2 keeps the unversioned file"""
+    return key_index_path(name if version <= 2 else f"{name}_{version}", path)
+
+
+def get_key_index(key_indexes, name, path=KEY_INDEX_PATH):
+    """ The index of the keys already written to a feature group, loaded from disk on first use"""
+    if name not in key_indexes:
+        key_indexes[name] = KeyIndex.load(sensor_key_index_path(name, path=path))
+    return key_indexes[name]
+
+
+def save_key_indexes(key_indexes, path=KEY_INDEX_PATH):
+    for name, index in key_indexes.items():
+        index.save(sensor_key_index_path(name, path=path))
+
+
+def upload_sensor_frames(fs, sensor_frames, buffer=None, key_indexes=None):
+    """ Inserts the frames into the feature group of each parking spot.
+
+    With a write buffer the rows are only buffered, and the feature groups whose
+    rows are old enough are flushed. With key_indexes (a dict of feature group
+    name -> KeyIndex, filled on demand) rows whose key was written before are
+    skipped and the written keys are added to the indexes.
+    Returns the number of written rows per parking spot.
+    """
+    written = {}
+    for psensor, df in sensor_frames.items():
+        name = sensor_feature_group_name(psensor)
+        if key_indexes is not None:
+            df = get_key_index(key_indexes, name).new_rows(df)
+        written[psensor] = len(df)
+        if df.empty:
+            continue
+        # Back to the float64 and string columns of the feature groups
+        stored = storage_frame(df)
+        if buffer is None:
+            get_sensor_feature_group(fs, name).insert(stored)
+        else:
+            buffer.add(name, stored)
+        if key_indexes is not None:
+            key_indexes[name].add(df['id'])
+    if buffer is not None:
+        buffer.flush_due()
+    return written
+
+
+def run_cycle(fs, weather_store, watermarks, session=None, dev_euis=None, watermark_path=WATERMARK_PATH, buffer=None,
+              key_indexes=None, feature_engine=None):
+    """ Runs the whole pipeline once: fetch, preprocess, upload and advance the watermarks.
+
+    The watermarks dict is updated in place and only saved after the upload (or
+    after the rows were spilled to the write buffer), like the key indexes, which
+    are kept in key_indexes between cycles when a dict is given, and the state of
+    the rolling feature engine.
+    Returns the number of new rows per parking spot and the failed sensors.
+    """
+    key_indexes = {} if key_indexes is None else key_indexes
+    dev_euis = dev_euis or get_dev_euis()
+    sensor_new_rows, failed_sensors = fetch_new_rows(dev_euis, watermarks, session)
+    report_failures(failed_sensors)
+    report_fcnt_gaps(sensor_new_rows, watermarks)
+
+    sensor_frames = prepare_sensor_frames(sensor_new_rows, weather_store, feature_engine)
+    written = upload_sensor_frames(fs, sensor_frames, buffer, key_indexes)
+
+    # Moving the watermarks forward only after the rows have been uploaded
+    for dev_eui, df in sensor_new_rows.items():
+        advance_watermark(watermarks, dev_eui, df)
+    save_watermarks(watermarks, watermark_path)
+    save_key_indexes(key_indexes)
+    if feature_engine is not None:
+        feature_engine.commit()
+
+    return written, failed_sensors
@@ -0,0 +1,111 @@
+# Incremental batch inference.
+# For every spot x modality model, the last scored event time and the ids scored at that
+# time are kept in state/scored_until.json. A run reads only the rows of the model's feature
+# group from that time on, skips the ones already scored, scores the rest in vectorized
+# batches and upserts one prediction per row, keyed by the row id.
+# The run time depends on the new data, not on the size of the archive.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from prediction_store import model_input
+from watermarks import load_watermarks, save_watermarks
+
+SCORED_PATH = os.getenv(
+    "SCORED_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "scored_until.json"),
+)
+BATCH_SIZE = 50_000
+
+# Prediction feature groups per label. Version 2 is keyed by the row id, version 1 used the raw feature values
+PREDICTION_GROUPS = {
+    "mag_cluster": {"name": "mag_parking_predictions", "column": "mag_cluster",
+                    "description": "Predictions for parking spots with magnetic data"},
+    "radar_cluster": {"name": "rad_parking_predictions", "column": "rad_cluster",
+                      "description": "Predictions for parking spots with radar data"},
+}
+PREDICTION_VERSION = 2
+
+
+def get_prediction_group(fs, label):
+    group = PREDICTION_GROUPS[label]
+    return fs.get_or_create_feature_group(name=group["name"],
+                                          version=PREDICTION_VERSION,
+                                          primary_key=["id"],
+                                          event_time='time',
+                                          description=group["description"],
+                                          online_enabled=False,
+                                          )
+
+
+def _scored_watermark(scored_until):
+    """ The {"time", "ids"} watermark of a spec, a plain time string is the format before the ids were kept"""
+    if scored_until is None or isinstance(scored_until, dict):
+        return scored_until
+    return {"time": scored_until, "ids": []}
+
+
+def read_unscored(fs, spec, scored_until=None):
+    """ The rows of a spec's parking spot that were not scored yet, sorted by time.
+
+    Rows at the last scored event time are read again, as late rows can still arrive
+    with that time, and the ones whose id was scored at that time are skipped.
+    """
+    fg = fs.get_feature_group(spec["feature_group"], version=spec["feature_group_version"])
+    condition = fg["psensor"] == spec["psensor"]
+    scored_until = _scored_watermark(scored_until)
+    if scored_until is not None:
+        condition = condition & (fg["time"] >= pd.Timestamp(scored_until["time"]).to_pydatetime())
+    df = fg.select(["id", "time", "psensor"] + spec["features"]).filter(condition).read(read_options={"use_hive": True})
+    df = df.drop_duplicates("id")
+    if scored_until is not None and scored_until["ids"]:
+        scored = (df["time"] == pd.Timestamp(scored_until["time"])) & df["id"].isin(scored_until["ids"])
+        df = df[~scored]
+    return df.sort_values("time", ignore_index=True)
+
+
+def scored_watermark(df, scored_until=None):
+    """ The last event time of the scored rows and the ids scored at that time, with the ones
+    of the previous watermark if the time did not move
+    """
+    last_time = df["time"].max()
+    ids = df.loc[df["time"] == last_time, "id"].tolist()
+    scored_until = _scored_watermark(scored_until)
+    if scored_until is not None and pd.Timestamp(scored_until["time"]) == pd.Timestamp(last_time):
+        ids = scored_until["ids"] + ids
+    return {"time": pd.Timestamp(last_time).isoformat(), "ids": ids}
+
+
+def score(df, spec, model, batch_size=BATCH_SIZE):
+    """ One prediction per row, in vectorized batches of batch_size rows"""
+    column = PREDICTION_GROUPS[spec["label"]]["column"]
+    predictions = df[["id", "time", "psensor"] + spec["features"]].copy()
+    predictions["data_type"] = spec["psensor"].lower()
+    X = model_input(df, spec["features"])
+    if X.empty:
+        predictions[column] = pd.Series(dtype=str)
+        return predictions
+    predictions[column] = np.concatenate([model.predict(X.iloc[start:start + batch_size])
+                                          for start in range(0, len(X), batch_size)])
+    return predictions
+
+
+def run_inference(fs, models, specs, scored_path=SCORED_PATH, batch_size=BATCH_SIZE):
+    """ Scores the new rows of every spec with models[spec name] and upserts the predictions.
+
+    The scored event time and ids of a spec only move after its predictions are inserted.
+    Returns the number of scored rows per spec.
+    """
+    scored_until = load_watermarks(scored_path)
+    scored = {}
+    for spec in specs:
+        df = read_unscored(fs, spec, scored_until.get(spec["name"]))
+        scored[spec["name"]] = len(df)
+        if df.empty:
+            continue
+        get_prediction_group(fs, spec["label"]).insert(score(df, spec, models[spec["name"]], batch_size))
+        scored_until[spec["name"]] = scored_watermark(df, scored_until.get(spec["name"]))
+        save_watermarks(scored_until, scored_path)
+    return scored
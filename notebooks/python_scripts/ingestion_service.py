@@ -0,0 +1,100 @@
+# Long-running ingestion service for the latest API feature pipeline.
+# Instead of a cold start every 10 minutes, the imports, the Hopsworks login, the API
+# session and the weather store stay loaded and the pipeline runs in a loop.
+#
+# Usage: python ingestion_service.py [--interval 60] [--jitter 0.1] [--max-cycles N]
+
+import argparse
+import os
+import random
+import signal
+import threading
+import time
+
+from sensor_api import create_session, get_dev_euis
+from watermarks import load_watermarks
+from weather_store import WeatherStore
+from feature_pipeline import run_cycle, create_write_buffer
+from local_feature_store import get_feature_store
+from rolling_features import RollingFeatureEngine
+
+# Defaults, can be overridden with environment variables or command line arguments
+INTERVAL_SECONDS = float(os.getenv("INGEST_INTERVAL_SECONDS", 60))
+JITTER = float(os.getenv("INGEST_JITTER", 0.1))
+
+
+def next_delay(interval, jitter):
+    """ The interval with +-jitter (a fraction of the interval) added, so sensors are not polled in lockstep"""
+    return max(0.0, interval * (1 + random.uniform(-jitter, jitter)))
+
+
+class IngestionService(object):
+
+    def __init__(self, interval=INTERVAL_SECONDS, jitter=JITTER, dev_euis=None):
+        """ Sets up the warm state that is reused between cycles"""
+        self.interval = interval
+        self.jitter = jitter
+        self.dev_euis = dev_euis or get_dev_euis()
+        self.stop_event = threading.Event()
+
+        self.fs = get_feature_store()
+        self.session = create_session()
+        self.weather_store = WeatherStore()
+        self.watermarks = load_watermarks()
+        # Rows are buffered and written in large inserts, by row count or age
+        self.buffer = create_write_buffer(self.fs)
+        # The keys already written per feature group, so replayed rows are skipped without a store lookup
+        self.key_indexes = {}
+        # Rolling baselines and variances per parking spot, updated with every cycle's rows
+        self.feature_engine = RollingFeatureEngine()
+
+    def stop(self, *args):
+        """ Asks the service to stop after the current cycle, also used as signal handler"""
+        print("Stopping after the current cycle", flush=True)
+        self.stop_event.set()
+
+    def run_once(self):
+        """ Runs one cycle, a failing cycle is reported and retried on the next one"""
+        start = time.perf_counter()
+        try:
+            new_rows, failed_sensors = run_cycle(self.fs, self.weather_store, self.watermarks,
+                                                 session=self.session, dev_euis=self.dev_euis,
+                                                 buffer=self.buffer, key_indexes=self.key_indexes,
+                                                 feature_engine=self.feature_engine)
+        except Exception as e:
+            print(f"Cycle failed: {e!r}", flush=True)
+            return False
+        print(f"Cycle done in {time.perf_counter() - start:.2f} s, new rows: {new_rows}, "
+              f"failed sensors: {len(failed_sensors)}", flush=True)
+        return True
+
+    def run(self, max_cycles=None):
+        """ Polls until stopped (SIGINT/SIGTERM) or until max_cycles have run"""
+        cycles = 0
+        try:
+            while not self.stop_event.is_set():
+                started = time.monotonic()
+                self.run_once()
+                cycles += 1
+                if max_cycles is not None and cycles >= max_cycles:
+                    break
+                # Waiting on the event so a shutdown signal interrupts the sleep right away
+                delay = next_delay(self.interval, self.jitter) - (time.monotonic() - started)
+                self.stop_event.wait(max(0.0, delay))
+        finally:
+            self.buffer.close()
+            self.session.close()
+        print(f"Ingestion service stopped after {cycles} cycles", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the latest API feature pipeline as a long-running service")
+    parser.add_argument("--interval", type=float, default=INTERVAL_SECONDS, help="seconds between cycles")
+    parser.add_argument("--jitter", type=float, default=JITTER, help="random +- fraction of the interval")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop after this many cycles")
+    args = parser.parse_args()
+
+    service = IngestionService(interval=args.interval, jitter=args.jitter)
+    signal.signal(signal.SIGINT, service.stop)
+    signal.signal(signal.SIGTERM, service.stop)
+    service.run(max_cycles=args.max_cycles)
@@ -0,0 +1,339 @@
+# Local feature store backend with the same get/insert/read surface as the Hopsworks
+# feature store we use. Feature groups are stored as Parquet datasets partitioned by
+# sensor and date, so time range and column selections only read the files they need.
+#
+# Set FEATURE_STORE_BACKEND=local to use it instead of Hopsworks in the pipelines and the app.
+
+import json
+import operator
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+FEATURE_STORE_PATH = os.getenv(
+    "LOCAL_FEATURE_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "feature_store"),
+)
+
+PARTITIONING = ds.partitioning(pa.schema([("psensor", pa.string()), ("event_date", pa.string())]), flavor="hive")
+# Hidden column used to keep the last inserted row per primary key
+INGESTED_AT = "_ingested_at"
+
+
+def use_local_feature_store():
+    return os.getenv("FEATURE_STORE_BACKEND", "hopsworks").lower() == "local"
+
+
+def get_feature_store(project=None):
+    """ Returns the local feature store or the Hopsworks one, depending on FEATURE_STORE_BACKEND"""
+    if use_local_feature_store():
+        return LocalFeatureStore()
+    if project is None:
+        import hopsworks
+        project = hopsworks.login(project="annikaij")
+    return project.get_feature_store()
+
+
+class Filter(object):
+
+    OPERATORS = {"==": operator.eq, "!=": operator.ne, ">": operator.gt,
+                 ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+    def __init__(self, feature, op, value):
+        """ A comparison on a feature, built with e.g. fg['psensor'] == "BUILDING" like in hsfs"""
+        self.feature = feature
+        self.op = op
+        self.value = value
+
+    def __and__(self, other):
+        return Logic([self]) & other
+
+    def to_expression(self, schema):
+        value = self.value
+        column_type = schema.field(self.feature).type
+        if pa.types.is_timestamp(column_type):
+            value = pd.Timestamp(value)
+            if column_type.tz is None:
+                # Aware values are compared in UTC with the naive columns
+                value = pa.scalar(value.to_datetime64(), type=column_type)
+            else:
+                # Naive values are taken to be in the timezone of the column
+                value = value.tz_localize(column_type.tz) if value.tz is None else value.tz_convert(column_type.tz)
+                value = pa.scalar(value, type=column_type)
+        return self.OPERATORS[self.op](ds.field(self.feature), value)
+
+
+def _as_filters(f):
+    """ The Filters of a Filter, a Logic or a list of them"""
+    if isinstance(f, Logic):
+        return list(f.filters)
+    if isinstance(f, (list, tuple)):
+        return [g for item in f for g in _as_filters(item)]
+    return [f]
+
+
+class Logic(object):
+
+    def __init__(self, filters):
+        """ Filters that must all hold, built with fg['a'] > 1 & fg['b'] == 2 like the hsfs Logic"""
+        self.filters = _as_filters(filters)
+
+    def __and__(self, other):
+        return Logic(self.filters + _as_filters(other))
+
+    def to_expression(self, schema):
+        expression = None
+        for f in self.filters:
+            e = f.to_expression(schema)
+            expression = e if expression is None else expression & e
+        return expression
+
+
+class Feature(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value): return Filter(self.name, "==", value)
+    def __ne__(self, value): return Filter(self.name, "!=", value)
+    def __gt__(self, value): return Filter(self.name, ">", value)
+    def __ge__(self, value): return Filter(self.name, ">=", value)
+    def __lt__(self, value): return Filter(self.name, "<", value)
+    def __le__(self, value): return Filter(self.name, "<=", value)
+
+    __hash__ = object.__hash__
+
+
+class LocalQuery(object):
+
+    def __init__(self, feature_group, columns=None, filters=()):
+        """ A selection of columns and filters on a feature group, read lazily"""
+        self.feature_group = feature_group
+        self.columns = columns
+        self.filters = list(filters)
+
+    def select(self, columns):
+        return LocalQuery(self.feature_group, list(columns), self.filters)
+
+    def filter(self, f):
+        return LocalQuery(self.feature_group, self.columns, self.filters + _as_filters(f))
+
+    def read(self, read_options=None, start_time=None, end_time=None, dataframe_type="pandas"):
+        """ Reads the selection, read_options is accepted for compatibility with hsfs and ignored"""
+        return self.feature_group.read(start_time=start_time, end_time=end_time,
+                                       columns=self.columns, filters=self.filters)
+
+    def to_string(self):
+        """ SQL-like text of the query, like hsfs Query.to_string"""
+        columns = ", ".join(self.columns) if self.columns else "*"
+        sql = f"SELECT {columns} FROM {self.feature_group.name}_{self.feature_group.version}"
+        if self.filters:
+            sql += " WHERE " + " AND ".join(f"{f.feature} {f.op} {f.value!r}" for f in self.filters)
+        return sql
+
+
+class LocalFeatureGroup(object):
+
+    def __init__(self, store, name, version, primary_key=None, event_time=None, description=""):
+        self.store = store
+        self.name = name
+        self.version = version
+        self.primary_key = list(primary_key or [])
+        self.event_time = event_time
+        self.description = description
+        self.path = os.path.join(store.root, f"{name}_{version}")
+        self.schema = None
+        if os.path.exists(self._metadata_path):
+            with open(self._metadata_path) as f:
+                metadata = json.load(f)
+            self.primary_key = metadata["primary_key"]
+            self.event_time = metadata["event_time"]
+            self.description = metadata["description"]
+            if metadata.get("schema"):
+                self.schema = pa.ipc.read_schema(pa.py_buffer(bytes.fromhex(metadata["schema"])))
+
+    @property
+    def _metadata_path(self):
+        return os.path.join(self.path, "_metadata.json")
+
+    def _save_metadata(self):
+        os.makedirs(self.path, exist_ok=True)
+        metadata = {
+            "primary_key": self.primary_key,
+            "event_time": self.event_time,
+            "description": self.description,
+            "schema": self.schema.serialize().to_pybytes().hex() if self.schema is not None else None,
+        }
+        with open(self._metadata_path + ".tmp", "w") as f:
+            json.dump(metadata, f, indent=1)
+        os.replace(self._metadata_path + ".tmp", self._metadata_path)
+
+    def __getitem__(self, name):
+        return Feature(name)
+
+    def get_feature(self, name):
+        return Feature(name)
+
+    def insert(self, df, write_options=None):
+        """ Appends the rows, partitioned by psensor and the date of the event time.
+
+        Rows with a primary key that already exists replace the old row on read.
+        """
+        if df.empty:
+            return
+        df = df.copy()
+        if "psensor" not in df.columns:
+            df["psensor"] = "ALL"
+        if self.event_time:
+            df["event_date"] = pd.to_datetime(df[self.event_time]).dt.strftime("%Y-%m-%d")
+        else:
+            df["event_date"] = "none"
+        df[INGESTED_AT] = time.time_ns()
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        data_schema = pa.schema([field for field in table.schema if field.name not in PARTITIONING.schema.names])
+        self.schema = data_schema if self.schema is None else pa.unify_schemas(
+            [self.schema, data_schema], promote_options="permissive")
+        ds.write_dataset(table, self.path, format="parquet", partitioning=PARTITIONING,
+                         basename_template=f"part-{time.time_ns()}-{{i}}.parquet",
+                         existing_data_behavior="overwrite_or_ignore")
+        self._save_metadata()
+
+    def _dataset(self):
+        schema = pa.unify_schemas([self.schema, PARTITIONING.schema])
+        return ds.dataset(self.path, schema=schema, format="parquet", partitioning=PARTITIONING,
+                          exclude_invalid_files=True, ignore_prefixes=["_", "."])
+
+    def read(self, start_time=None, end_time=None, columns=None, filters=(), read_options=None):
+        """ Reads the feature group, pushing the time range, filters and columns down to Parquet.
+
+        The time range (start inclusive, end exclusive) on the event time and
+        filters on psensor also prune whole partitions.
+        """
+        if self.schema is None:
+            return pd.DataFrame(columns=columns)
+        dataset = self._dataset()
+
+        expressions = [f.to_expression(dataset.schema) for f in filters]
+        if start_time is not None:
+            expressions.append(Filter(self.event_time, ">=", start_time).to_expression(dataset.schema))
+            expressions.append(ds.field("event_date") >= pd.Timestamp(start_time).strftime("%Y-%m-%d"))
+        if end_time is not None:
+            expressions.append(Filter(self.event_time, "<", end_time).to_expression(dataset.schema))
+            expressions.append(ds.field("event_date") <= pd.Timestamp(end_time).strftime("%Y-%m-%d"))
+        expression = None
+        for e in expressions:
+            expression = e if expression is None else expression & e
+
+        read_columns = None
+        if columns is not None:
+            read_columns = list(dict.fromkeys(list(columns) + self.primary_key + [INGESTED_AT]))
+        df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+
+        # Keeping the last inserted version of every primary key
+        if self.primary_key:
+            df = (df.sort_values(INGESTED_AT, kind="stable")
+                    .drop_duplicates(subset=self.primary_key, keep="last"))
+        if self.event_time and self.event_time in df.columns:
+            df = df.sort_values(self.event_time, kind="stable")
+        df = df.drop(columns=[INGESTED_AT, "event_date"], errors="ignore").reset_index(drop=True)
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    def select_all(self):
+        return LocalQuery(self)
+
+    def select(self, columns):
+        return LocalQuery(self, list(columns))
+
+    def filter(self, f):
+        return LocalQuery(self).filter(f)
+
+
+class LocalFeatureView(object):
+
+    def __init__(self, name, version, query, labels=(), inference_helper_columns=()):
+        self.name = name
+        self.version = version
+        self.query = query
+        self.labels = list(labels)
+        self.inference_helper_columns = list(inference_helper_columns)
+
+    def _features(self):
+        columns = self.query.columns or list(self.query.feature_group.schema.names)
+        return [c for c in columns if c not in self.labels + self.inference_helper_columns]
+
+    def get_batch_data(self, start_time=None, end_time=None, inference_helpers=False, read_options=None):
+        """ Reads the features (without labels) of the feature view, optionally for a time range"""
+        columns = self._features() + (self.inference_helper_columns if inference_helpers else [])
+        return self.query.select(columns).read(start_time=start_time, end_time=end_time)
+
+    def training_data(self, start_time=None, end_time=None, primary_key=False, event_time=False, **kwargs):
+        """ Returns X, y for a time range of the event time like the hsfs feature view.
+
+        With primary_key and event_time, X starts with the primary key and event time columns.
+        """
+        fg = self.query.feature_group
+        extra = (fg.primary_key if primary_key else []) + ([fg.event_time] if event_time and fg.event_time else [])
+        columns = list(dict.fromkeys(extra + self._features()))
+        df = self.query.select(columns + self.labels).read(start_time=start_time, end_time=end_time)
+        return df[columns], df[self.labels]
+
+    def train_test_split(self, test_size, start_time=None, end_time=None, random_state=None):
+        """ Returns X_train, X_test, y_train, y_test like the hsfs feature view"""
+        from sklearn.model_selection import train_test_split
+
+        df = self.query.select(self._features() + self.labels).read(start_time=start_time, end_time=end_time)
+        return train_test_split(df[self._features()], df[self.labels], test_size=test_size, random_state=random_state)
+
+
+class LocalFeatureStore(object):
+
+    def __init__(self, root=FEATURE_STORE_PATH):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.feature_views = {}
+
+    def get_or_create_feature_group(self, name, version=1, primary_key=None, event_time=None,
+                                    description="", online_enabled=False, **kwargs):
+        fg = LocalFeatureGroup(self, name, version, primary_key, event_time, description)
+        if not os.path.exists(fg._metadata_path):
+            fg._save_metadata()
+        return fg
+
+    def get_feature_group(self, name, version=1):
+        fg = LocalFeatureGroup(self, name, version)
+        if not os.path.exists(fg._metadata_path):
+            raise KeyError(f"Feature group {name} version {version} does not exist")
+        return fg
+
+    def _view_path(self, name, version):
+        return os.path.join(self.root, "_feature_views", f"{name}_{version}.json")
+
+    def create_feature_view(self, name, query, version=1, labels=(), inference_helper_columns=(), **kwargs):
+        """ Saves the feature view definition (feature group, columns, equality filters)"""
+        fg = query.feature_group
+        definition = {
+            "feature_group": fg.name, "feature_group_version": fg.version, "columns": query.columns,
+            "filters": [[f.feature, f.op, f.value] for f in query.filters],
+            "labels": list(labels), "inference_helper_columns": list(inference_helper_columns),
+        }
+        path = self._view_path(name, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(definition, f, indent=1, default=str)
+        return self.get_feature_view(name, version)
+
+    def get_feature_view(self, name, version=1):
+        path = self._view_path(name, version)
+        if not os.path.exists(path):
+            raise KeyError(f"Feature view {name} version {version} does not exist")
+        with open(path) as f:
+            definition = json.load(f)
+        fg = self.get_feature_group(definition["feature_group"], definition["feature_group_version"])
+        query = LocalQuery(fg, definition["columns"], [Filter(*f) for f in definition["filters"]])
+        return LocalFeatureView(name, version, query, definition["labels"], definition["inference_helper_columns"])
@@ -0,0 +1,69 @@
+# One-off migration of the new_<spot>_fg feature groups to version 3.
+# Version 3 packs UTC times in the row keys and adds the rolling features, so the rows of
+# the old version are read, keyed again with row_keys.py, get the rolling features from an
+# empty state in UTC time order and are written to version 3. Rows that are already in
+# version 3 are kept as they are. The rolling state and the key index of version 3 are
+# saved afterwards, so the pipelines continue incrementally from the migrated rows.
+#
+# Run it once while the pipelines are stopped (or still run with SENSOR_FG_VERSION=2),
+# then switch the pipelines, the inference and the app to version 3.
+# Rows of the migrated history get their stored predictions from the next inference runs
+# or are scored by the dashboard on read.
+#
+# Usage: python migrate_sensor_fg.py [from_version]   (2 by default)
+
+import numpy as np
+import pandas as pd
+
+from feature_pipeline import get_sensor_feature_group, sensor_feature_group_name, sensor_key_index_path
+from row_keys import KeyIndex, row_keys
+from rolling_features import RollingFeatureEngine
+from sensor_api import SENSORS
+from sensor_frames import compact_frame, storage_frame
+
+TARGET_VERSION = 3
+
+
+def migrate_spot(fs, psensor, feature_engine, from_version=2, to_version=TARGET_VERSION):
+    """ Copies the rows of a parking spot from one version of its feature group to another.
+
+    Returns the number of written rows. The rolling state of the spot is pending in
+    feature_engine until feature_engine.commit().
+    """
+    name = sensor_feature_group_name(psensor)
+    old = fs.get_feature_group(name=name, version=from_version).read()
+    target = get_sensor_feature_group(fs, name, version=to_version)
+    current = target.read()
+    df = pd.concat([old, current], ignore_index=True) if len(current) else old
+    if df.empty:
+        return 0
+
+    df = compact_frame(df)
+    df['psensor'] = psensor
+    df['id'] = row_keys(df)
+    # The rows already in the target version win over the copies of the old version
+    df = df[~pd.Series(df['id']).duplicated(keep='last').to_numpy()]
+
+    # From an empty state, the whole history is one batch
+    feature_engine.states.pop(psensor, None)
+    df = feature_engine.transform(psensor, df)
+    target.insert(storage_frame(df))
+    KeyIndex(df['id'].to_numpy(dtype=np.int64)).save(sensor_key_index_path(name, to_version))
+    return len(df)
+
+
+def migrate(fs, from_version=2, to_version=TARGET_VERSION):
+    """ Migrates the feature groups of all parking spots and saves the rolling state"""
+    feature_engine = RollingFeatureEngine()
+    for psensor in SENSORS.values():
+        written = migrate_spot(fs, psensor, feature_engine, from_version, to_version)
+        print(f"{sensor_feature_group_name(psensor)}: {written} rows from version {from_version} to {to_version}")
+    feature_engine.commit()
+
+
+if __name__ == "__main__":
+    import sys
+
+    from local_feature_store import get_feature_store
+
+    migrate(get_feature_store(), from_version=int(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,132 @@
+# Memory-mappable artifact format for the KNN detection models.
+# A KNeighborsClassifier pickle holds the whole training matrix, so every process that
+# loads it gets its own copy. This format stores the fitted points, labels and feature
+# order as raw .npy files plus a small manifest. The points are opened with mmap_mode,
+# so processes loading the same artifact share the pages and start almost instantly.
+#
+# Usage: python model_artifacts.py ../models/*.pkl   (converts pickles to artifact folders)
+
+import json
+import os
+
+import joblib
+import numpy as np
+from sklearn.neighbors import KDTree
+
+ARTIFACT_FORMAT = "knn-npy"
+ARTIFACT_VERSION = 1
+MANIFEST = "manifest.json"
+
+# Leaf size of the KD-tree over the fitted points, the default of KNeighborsClassifier
+LEAF_SIZE = 30
+
+
+def save_knn_artifact(model, directory, name):
+    """ Saves a fitted euclidean KNeighborsClassifier as an artifact folder directory/name"""
+    if model.effective_metric_ != "euclidean":
+        raise ValueError(f"Only euclidean KNN models can be saved as {ARTIFACT_FORMAT}, got {model.effective_metric_}")
+    path = os.path.join(directory, name)
+    os.makedirs(path, exist_ok=True)
+
+    fit_X = np.ascontiguousarray(model._fit_X, dtype=np.float64)
+    np.save(os.path.join(path, "fit_X.npy"), fit_X)
+    np.save(os.path.join(path, "y.npy"), np.ascontiguousarray(model._y, dtype=np.int64))
+    feature_names = getattr(model, "feature_names_in_", None)
+    manifest = {
+        "format": ARTIFACT_FORMAT,
+        "version": ARTIFACT_VERSION,
+        "n_neighbors": int(model.n_neighbors),
+        "weights": model.weights,
+        "classes": [c.item() if hasattr(c, "item") else c for c in model.classes_],
+        "feature_names": list(feature_names) if feature_names is not None else None,
+        "n_samples": int(fit_X.shape[0]),
+        "n_features": int(fit_X.shape[1]),
+    }
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return path
+
+
+def is_knn_artifact(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+class MmapKNN(object):
+
+    def __init__(self, path, mmap_mode="r"):
+        """ Loads an artifact folder, the fitted points stay memory mapped"""
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != ARTIFACT_FORMAT or manifest.get("version") != ARTIFACT_VERSION:
+            raise ValueError(f"{path} is not a {ARTIFACT_FORMAT} v{ARTIFACT_VERSION} artifact")
+        self.path = path
+        self.n_neighbors = manifest["n_neighbors"]
+        self.weights = manifest["weights"]
+        self.classes_ = np.array(manifest["classes"])
+        self.feature_names_in_ = np.array(manifest["feature_names"]) if manifest["feature_names"] else None
+        self.n_features_in_ = manifest["n_features"]
+        self._fit_X = np.load(os.path.join(path, "fit_X.npy"), mmap_mode=mmap_mode)
+        self._y = np.load(os.path.join(path, "y.npy"), mmap_mode=mmap_mode)
+        self._tree = None
+
+    def _as_array(self, X):
+        """ Orders DataFrame columns like the training data, like sklearn does by name"""
+        if hasattr(X, "columns") and self.feature_names_in_ is not None:
+            X = X[list(self.feature_names_in_)]
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        return X
+
+    @property
+    def tree(self):
+        """ KD-tree over the fitted points, built on first use. It indexes the mapped array
+        in place, only the tree nodes and the point order are per process
+        """
+        if self._tree is None:
+            self._tree = KDTree(self._fit_X, leaf_size=LEAF_SIZE)
+        return self._tree
+
+    def kneighbors(self, X):
+        """ Exact euclidean distances and indices of the n_neighbors nearest fitted points, nearest first"""
+        return self.tree.query(self._as_array(X), k=self.n_neighbors)
+
+    def predict(self, X):
+        """ Majority (or distance weighted) vote of the neighbours, ties go to the first class like in sklearn"""
+        distances, indices = self.kneighbors(X)
+        labels = self._y[indices]
+        if self.weights == "distance":
+            with np.errstate(divide="ignore"):
+                weights = 1.0 / distances
+            # Exact matches get all the weight, like in sklearn
+            exact = np.isinf(weights)
+            weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+        else:
+            weights = np.ones_like(distances)
+        votes = np.zeros((len(labels), len(self.classes_)))
+        np.add.at(votes, (np.arange(len(labels))[:, None], labels), weights)
+        return self.classes_[votes.argmax(axis=1)]
+
+
+def load_model(path, mmap_mode="r"):
+    """ Loads an artifact folder with mmap, or a joblib pickle"""
+    if is_knn_artifact(path):
+        return MmapKNN(path, mmap_mode)
+    return joblib.load(path)
+
+
+def load_model_from_dir(model_dir, name, mmap_mode="r"):
+    """ Loads model_dir/name as artifact folder if there is one, otherwise model_dir/name.pkl"""
+    artifact_path = os.path.join(model_dir, name)
+    if is_knn_artifact(artifact_path):
+        return MmapKNN(artifact_path, mmap_mode)
+    return joblib.load(artifact_path + ".pkl")
+
+
+if __name__ == "__main__":
+    import sys
+
+    for pkl_path in sys.argv[1:]:
+        directory, file_name = os.path.split(pkl_path)
+        path = save_knn_artifact(joblib.load(pkl_path), directory, os.path.splitext(file_name)[0])
+        print(f"{pkl_path} -> {path}")
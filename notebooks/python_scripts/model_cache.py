@@ -0,0 +1,83 @@
+# Process-wide cache of the detection models.
+# Every model is loaded once and shared by all users of the process. A background
+# thread polls the model registry and swaps in new versions when they appear.
+
+import threading
+
+from model_artifacts import load_model_from_dir
+
+MODEL_NAMES = ["building_mag_hist_model", "building_rad_hist_model",
+               "bikelane_mag_hist_model", "bikelane_rad_hist_model"]
+
+POLL_SECONDS = 300
+
+
+def latest_version(mr, name):
+    """ The newest registered version of a model, every training run uploads a new one"""
+    return max(model.version for model in mr.get_models(name))
+
+
+def load_registry_model(mr, name, version):
+    """ Downloads a model version from the registry and loads it, memory mapped if it has an artifact folder"""
+    model_dir = mr.get_model(name, version=version).download()
+    return load_model_from_dir(model_dir, name)
+
+
+class ModelCache(object):
+
+    def __init__(self, model_registry, model_names=MODEL_NAMES, poll_seconds=POLL_SECONDS, loader=load_registry_model):
+        """ Loads the latest version of every model"""
+        self.mr = model_registry
+        self.model_names = list(model_names)
+        self.poll_seconds = poll_seconds
+        self.loader = loader
+        self.stop_event = threading.Event()
+        self.thread = None
+        # name -> (version, model). The dict is replaced as a whole, never changed in place,
+        # so readers always see a complete set without taking a lock
+        self.models = {}
+        self.refresh()
+
+    def latest_version(self, name):
+        return latest_version(self.mr, name)
+
+    def refresh(self):
+        """ Loads the models whose registry version changed and swaps them in. Returns the swapped names"""
+        swapped = []
+        for name in self.model_names:
+            try:
+                version = self.latest_version(name)
+                if name in self.models and self.models[name][0] == version:
+                    continue
+                # Loading outside the swap, requests keep using the old version meanwhile
+                model = self.loader(self.mr, name, version)
+            except Exception as e:
+                if name not in self.models:
+                    raise
+                print(f"Could not refresh {name}, keeping version {self.models[name][0]}: {e!r}", flush=True)
+                continue
+            self.models = {**self.models, name: (version, model)}
+            swapped.append(name)
+        return swapped
+
+    def get(self, name):
+        return self.models[name][1]
+
+    def version(self, name):
+        return self.models[name][0]
+
+    def _poll(self):
+        while not self.stop_event.wait(self.poll_seconds):
+            swapped = self.refresh()
+            if swapped:
+                print(f"Swapped in new model versions: {swapped}", flush=True)
+
+    def start(self):
+        """ Starts polling the registry in a daemon thread"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._poll, name="model-cache-poller", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
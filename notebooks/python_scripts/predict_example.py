@@ -1,16 +1,30 @@
 import os
 import numpy as np
-import hsfs
 import joblib
 
+from model_artifacts import load_model_from_dir
+from fast_path import FastKNN
+
 class Predict(object):
 
-    def __init__(self):
+    def __init__(self, model_name="EL123_model", model_dir=None):
         """ Initializes the serving state, reads a trained model"""        
-        # load the trained model
-        self.model = joblib.load(os.environ["ARTIFACT_FILES_PATH"] + "/EL123_model.pkl")
+        # load the trained model, memory mapped if there is an artifact folder for it
+        self.model = load_model_from_dir(model_dir or os.environ["ARTIFACT_FILES_PATH"], model_name)
+        # single-row fast path, the model internals are precomputed once here
+        self.fast = FastKNN(self.model)
         print("Initialization Complete")
 
     def predict(self, inputs):
         """ Serves a prediction request usign a trained model"""        
-        return self.model.predict(np.asarray(inputs).reshape(1, -1)).tolist() # Numpy Arrays are not JSON serializable
+        label = self.fast.predict_one(np.asarray(inputs, dtype=np.float64).ravel())
+        # Numpy Arrays are not JSON serializable, the classes can be NumPy scalars or Python strings
+        return [np.asarray(label).tolist()]
+
+    def predict_batch(self, inputs):
+        """ Serves a batch of feature vectors, returns the class indices into self.fast.classes"""
+        return self.fast.predict_indices(np.asarray(inputs, dtype=np.float64))
+
+    def latency(self):
+        """ Latency histogram of the served predictions"""
+        return self.fast.latency_summary()
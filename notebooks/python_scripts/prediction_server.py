@@ -0,0 +1,196 @@
+# Micro-batching prediction server around Predict.
+# Requests arrive concurrently over HTTP on localhost. Each spot/modality model has a
+# batcher thread that collects the waiting feature vectors until the batch is full or the
+# latency budget has passed, and scores them with one call. The responses are built from
+# pre-encoded JSON labels, so no numpy array is converted element by element.
+#
+# Usage: python prediction_server.py [--port 8090] [--latency-ms 2] [--max-batch 256] [--max-rows 4096]
+#
+#   POST /predict/<spot>/<modality>   spot: building|bikelane, modality: mag|rad
+#   body {"inputs": [[x, y, z, temperature, et0], ...]}  or a single vector, at most --max-rows vectors
+#   response {"predictions": ["detection", ...]}, status 413 for larger requests
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from predict_example import Predict
+
+HOST = "127.0.0.1"
+PORT = int(os.getenv("PREDICT_PORT", 8090))
+MODEL_DIR = os.getenv("PREDICT_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+LATENCY_BUDGET_MS = float(os.getenv("PREDICT_LATENCY_MS", 2))
+MAX_BATCH = int(os.getenv("PREDICT_MAX_BATCH", 256))
+# Vectors per request, larger requests get 413 instead of holding up the batches of everyone else
+MAX_ROWS = int(os.getenv("PREDICT_MAX_ROWS", 4096))
+# Request bodies above this many bytes per allowed row are refused before they are read
+MAX_BYTES_PER_ROW = 1024
+
+SPOTS = ["building", "bikelane"]
+MODALITIES = ["mag", "rad"]
+
+
+def model_name(spot, modality):
+    return f"{spot}_{modality}_hist_model"
+
+
+class MicroBatcher(object):
+
+    def __init__(self, predictor, latency_budget_ms=LATENCY_BUDGET_MS, max_batch=MAX_BATCH):
+        """ Coalesces the requests for one Predict into batches, scored in a daemon thread"""
+        self.predictor = predictor
+        self.latency_budget = latency_budget_ms / 1000
+        self.max_batch = max_batch
+        # Each class label as JSON once, a response is a join of these
+        self.encoded_labels = [json.dumps(c.item() if hasattr(c, "item") else c) for c in predictor.fast.classes]
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.rows = 0
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, X):
+        """ Queues a (n, features) array, the future resolves to the JSON list of its labels"""
+        future = Future()
+        self.requests.put((X, future))
+        return future
+
+    def _collect(self):
+        """ Blocks for the first request, then takes more until the batch is full or the budget is used"""
+        batch = [self.requests.get()]
+        n_rows = len(batch[0][0])
+        deadline = time.monotonic() + self.latency_budget
+        while n_rows < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_rows += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                indices = self.predictor.predict_batch(np.concatenate([X for X, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.rows += len(indices)
+            start = 0
+            for X, future in batch:
+                labels = indices[start:start + len(X)]
+                start += len(X)
+                future.set_result("[" + ",".join(self.encoded_labels[i] for i in labels) + "]")
+
+
+def create_batchers(model_dir=MODEL_DIR, latency_budget_ms=LATENCY_BUDGET_MS, max_batch=MAX_BATCH):
+    """ One batcher per spot/modality model found in model_dir"""
+    batchers = {}
+    for spot in SPOTS:
+        for modality in MODALITIES:
+            try:
+                predictor = Predict(model_name(spot, modality), model_dir)
+            except FileNotFoundError:
+                print(f"No model {model_name(spot, modality)} in {model_dir}, /predict/{spot}/{modality} is disabled")
+                continue
+            batchers[(spot, modality)] = MicroBatcher(predictor, latency_budget_ms, max_batch)
+    return batchers
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+
+    # Set by create_server
+    batchers = {}
+    max_rows = MAX_ROWS
+
+    def _reply(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "predict" or (parts[1], parts[2]) not in self.batchers:
+            self._reply(404, json.dumps({"error": f"Unknown route {self.path}, use /predict/<spot>/<modality>"}))
+            return
+        batcher = self.batchers[(parts[1], parts[2])]
+        too_large = json.dumps({"error": f"At most {self.max_rows} vectors per request"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > self.max_rows * MAX_BYTES_PER_ROW:
+                # Not reading the body, the connection is closed after the reply
+                self.close_connection = True
+                self._reply(413, too_large)
+                return
+            payload = json.loads(self.rfile.read(length))
+            X = np.asarray(payload["inputs"], dtype=np.float64)
+            if X.ndim == 1:
+                X = X.reshape(1, -1)
+            if X.ndim != 2 or X.shape[1] != batcher.predictor.fast.fit_X.shape[1]:
+                raise ValueError(f"Expected vectors of {batcher.predictor.fast.fit_X.shape[1]} features, got shape {X.shape}")
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, json.dumps({"error": str(e)}))
+            return
+        if len(X) > self.max_rows:
+            self._reply(413, too_large)
+            return
+        predictions = batcher.submit(X).result()
+        self._reply(200, '{"predictions":' + predictions + '}')
+
+    def do_GET(self):
+        if self.path.strip("/") != "stats":
+            self._reply(404, json.dumps({"error": f"Unknown route {self.path}"}))
+            return
+        stats = {f"{spot}/{modality}": {"batches": b.batches, "rows": b.rows}
+                 for (spot, modality), b in self.batchers.items()}
+        self._reply(200, json.dumps(stats))
+
+    def log_message(self, format, *args):
+        # One line per request would cost more than the prediction
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    # The default backlog of 5 resets connections when many clients send at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def create_server(batchers, host=HOST, port=PORT, max_rows=MAX_ROWS):
+    handler = type("Handler", (PredictionHandler,), {"batchers": batchers, "max_rows": max_rows})
+    return PredictionServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching prediction server")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_BUDGET_MS, help="How long a request may wait for a batch")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--max-rows", type=int, default=MAX_ROWS, help="Vectors per request, larger requests get 413")
+    args = parser.parse_args()
+
+    server = create_server(create_batchers(args.model_dir, args.latency_ms, args.max_batch), port=args.port,
+                           max_rows=args.max_rows)
+    print(f"Serving predictions on http://{HOST}:{args.port}/predict/<spot>/<modality>", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
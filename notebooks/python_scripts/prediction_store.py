@@ -0,0 +1,113 @@
+# Prediction store for the dashboard.
+# The inference job writes the magnetic field and radar status of every row in the
+# new_*_fg feature groups, keyed by the row id. The dashboard looks the statuses up
+# and only scores the rows that have no stored prediction yet.
+
+import os
+
+import pandas as pd
+
+from row_keys import KeyIndex, key_index_path
+
+# The last scored hour (UTC) of each new_*_fg feature group, see read_unscored_rows
+DASHBOARD_SCORED_PATH = os.getenv(
+    "DASHBOARD_SCORED_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "dashboard_scored_until.json"),
+)
+
+PREDICTION_FG_NAME = "dashboard_predictions"
+# Version 2 is keyed by the int64 row keys of the new_*_fg feature groups (see row_keys.py)
+PREDICTION_FG_VERSION = 2
+
+# The features the models are trained on, in the order of the feature views
+MAG_FEATURES = ['x', 'y', 'z', 'temperature', 'et0_fao_evapotranspiration']
+RADAR_FEATURES = ['radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7', 'temperature', 'et0_fao_evapotranspiration']
+
+PREDICTION_COLUMNS = ['id', 'time', 'psensor', 'mag_status', 'radar_status']
+
+
+def use_prediction_store():
+    """ The dashboard reads from the prediction store unless PREDICTION_STORE=off"""
+    return os.getenv("PREDICTION_STORE", "on").lower() != "off"
+
+
+def get_prediction_feature_group(fs):
+    return fs.get_or_create_feature_group(name=PREDICTION_FG_NAME,
+                                      version=PREDICTION_FG_VERSION,
+                                      primary_key=["id"],
+                                      event_time='time',
+                                      description="Magnetic field and radar predictions for each row of the new_*_fg feature groups",
+                                      online_enabled=False,
+                                     )
+
+
+def model_input(df, features):
+    """ The feature columns of a frame, with a missing evapotranspiration filled with 0 like in the app"""
+    X = df[features].copy()
+    X['et0_fao_evapotranspiration'] = X['et0_fao_evapotranspiration'].fillna(0)
+    return X
+
+
+def score_rows(df, mag_model, rad_model):
+    """ Scores the rows with both models in one vectorized call each"""
+    predictions = df[['id', 'time', 'psensor']].copy()
+    if df.empty:
+        predictions['mag_status'] = pd.Series(dtype=str)
+        predictions['radar_status'] = pd.Series(dtype=str)
+        return predictions
+    predictions['mag_status'] = mag_model.predict(model_input(df, MAG_FEATURES))
+    predictions['radar_status'] = rad_model.predict(model_input(df, RADAR_FEATURES))
+    return predictions
+
+
+def read_predictions(prediction_fg, psensor, start_time):
+    """ Reads the stored predictions of a parking spot from start_time on"""
+    query = prediction_fg.select_all().filter(
+        (prediction_fg['psensor'] == psensor) & (prediction_fg['time'] >= start_time))
+    return query.read(read_options={"use_hive": True})
+
+
+def get_statuses(df, stored_predictions, mag_model, rad_model):
+    """ Returns the predictions for the rows of df.
+
+    Predictions are taken from stored_predictions by id, only the rows without a
+    stored prediction are scored here.
+    """
+    if stored_predictions is None or stored_predictions.empty:
+        return score_rows(df, mag_model, rad_model)
+    stored = stored_predictions.drop_duplicates('id', keep='last').set_index('id')
+    known = df['id'].isin(stored.index)
+
+    predictions = df.loc[known, ['id', 'time', 'psensor']].copy()
+    predictions['mag_status'] = stored.loc[predictions['id'], 'mag_status'].values
+    predictions['radar_status'] = stored.loc[predictions['id'], 'radar_status'].values
+    missing = score_rows(df.loc[~known], mag_model, rad_model)
+    return pd.concat([predictions, missing]).loc[df.index]
+
+
+def read_unscored_rows(new_fg, scored_hour=None):
+    """ The rows of a new_*_fg feature group from the last scored hour on.
+
+    The hour is the UTC time_hour, which never repeats like the local time does when
+    DST ends. The rows of the last scored hour are read again, as rows can still arrive
+    for it, the ones with a stored prediction are skipped by id.
+    """
+    query = new_fg.select_all()
+    if scored_hour is not None:
+        query = query.filter(new_fg['time_hour'] >= pd.Timestamp(scored_hour).to_pydatetime())
+    return query.read(read_options={"use_hive": True})
+
+
+def load_prediction_ids(prediction_fg, path=None):
+    """ The KeyIndex of the ids with a stored prediction, saved in state/keys like the keys of feature_pipeline.py.
+
+    Only when there is no saved index yet, it is built once from the ids in the feature group.
+    """
+    path = path or key_index_path(PREDICTION_FG_NAME)
+    if os.path.exists(path):
+        return KeyIndex.load(path)
+    try:
+        return KeyIndex(prediction_fg.select(['id']).read(read_options={"use_hive": True})['id'])
+    except Exception:
+        # The prediction feature group is created on the first insert
+        return KeyIndex()
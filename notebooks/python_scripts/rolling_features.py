@@ -0,0 +1,207 @@
+# Rolling-window features of the magnetic and radar channels.
+# Per parking spot and channel an exponentially weighted baseline and variance are kept,
+# and every row gets its deviation from the baseline before it (delta), the baseline
+# itself and the rolling variance, plus the magnitude of the magnetic field.
+#
+# Both statistics are first order recursions, evaluated with scipy.signal.lfilter from
+# the saved state. A new row costs O(1) and the state (last baseline and variance per
+# channel) is saved between pipeline runs. The batch computation over the history for
+# training runs the same function from an empty state, so feeding the rows in one batch
+# or in any number of increments gives bit-identical features.
+#
+# Usage: python rolling_features.py [path/to/backfill]   (checks batch == incremental on the backfilled rows)
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from sensor_frames import RADAR_COLUMNS
+from time_utils import utc_times
+
+ROLLING_STATE_PATH = os.getenv(
+    "ROLLING_STATE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "rolling_features.json"),
+)
+# Half-life of the baseline and variance, in samples of the sensor
+HALFLIFE_SAMPLES = float(os.getenv("ROLLING_HALFLIFE_SAMPLES", 64))
+
+MAG_COLUMNS = ['x', 'y', 'z']
+FEATURE_CHANNELS = MAG_COLUMNS + ['mag_magnitude'] + RADAR_COLUMNS
+
+
+def feature_columns(channels=FEATURE_CHANNELS):
+    """ The columns added by rolling_features, in order"""
+    return ['mag_magnitude'] + [f"{channel}_{kind}" for channel in channels for kind in ("baseline", "delta", "var")]
+
+
+def _alpha(halflife):
+    return 1.0 - np.exp(-np.log(2.0) / halflife)
+
+
+def _channel_features(values, channel_state, alpha):
+    """ Baseline, delta and variance of one channel's (non missing) values from its state.
+
+    baseline[t] is the mean before sample t, delta[t] = value[t] - baseline[t] and
+    var[t] = (1 - alpha) * (var[t-1] + alpha * delta[t]**2) includes sample t.
+    Returns the three arrays and the new state.
+    """
+    decay = 1.0 - alpha
+    if channel_state is None:
+        # The first sample of a channel is its own baseline
+        channel_state = {"mean": float(values[0]), "var": 0.0}
+    means, _ = lfilter([alpha], [1.0, -decay], values, zi=[decay * channel_state["mean"]])
+    baseline = np.concatenate([[channel_state["mean"]], means[:-1]])
+    delta = values - baseline
+    variances, _ = lfilter([decay * alpha], [1.0, -decay], delta * delta, zi=[decay * channel_state["var"]])
+    return baseline, delta, variances, {"mean": float(means[-1]), "var": float(variances[-1])}
+
+
+def _magnitude(xyz):
+    """ The magnitude of the magnetic field, sqrt(x² + y² + z²)"""
+    return np.sqrt((xyz * xyz).sum(axis=1))
+
+
+def rolling_features(df, state=None, halflife=HALFLIFE_SAMPLES, channels=FEATURE_CHANNELS):
+    """ The rolling features of the rows of one parking spot, in time order, from a saved state.
+
+    Rows with a missing channel value get missing features for that channel and do
+    not change its state. Returns a DataFrame with the index of df and the new state.
+    """
+    alpha = _alpha(halflife)
+    state = {"n": 0, "channels": {}} if state is None else state
+    new_state = {"n": state["n"] + len(df), "channels": dict(state["channels"])}
+
+    # One float64 block of the raw channels, the magnitude is computed from its x, y, z columns
+    raw = df.reindex(columns=MAG_COLUMNS + RADAR_COLUMNS).to_numpy(dtype=np.float64)
+    magnitude = _magnitude(raw[:, :len(MAG_COLUMNS)])
+    sources = dict(zip(MAG_COLUMNS + RADAR_COLUMNS, raw.T))
+    sources['mag_magnitude'] = magnitude
+
+    out = np.full((len(df), 1 + 3 * len(channels)), np.nan)
+    out[:, 0] = magnitude
+    for i, channel in enumerate(channels):
+        values = sources[channel]
+        valid = ~np.isnan(values)
+        if valid.any():
+            baseline, delta, variances, new_state["channels"][channel] = _channel_features(
+                values[valid], state["channels"].get(channel), alpha)
+            out[valid, 1 + 3 * i], out[valid, 2 + 3 * i], out[valid, 3 + 3 * i] = baseline, delta, variances
+    return pd.DataFrame(out, columns=feature_columns(channels), index=df.index), new_state
+
+
+def _time_order(df):
+    """ The positions of the rows in UTC time order (f_cnt breaks ties), like the rows arrive"""
+    if 'time' not in df.columns:
+        return np.arange(len(df))
+    keys = [utc_times(df)] + ([df['f_cnt'].to_numpy(dtype=np.float64)] if 'f_cnt' in df.columns else [])
+    return np.lexsort(keys[::-1])
+
+
+def batch_features(df, halflife=HALFLIFE_SAMPLES, channels=FEATURE_CHANNELS):
+    """ The rolling features over a history of one or more parking spots, from an empty state.
+
+    The rows of each spot are processed in time order, the result has the index of df.
+    """
+    parts = []
+    groups = df.groupby('psensor', observed=True, sort=False) if 'psensor' in df.columns else [(None, df)]
+    for _, group in groups:
+        group = group.iloc[_time_order(group)]
+        parts.append(rolling_features(group, None, halflife, channels)[0])
+    if not parts:
+        return pd.DataFrame(columns=feature_columns(channels), index=df.index, dtype=np.float64)
+    return pd.concat(parts).loc[df.index]
+
+
+class RollingFeatureEngine(object):
+
+    def __init__(self, path=ROLLING_STATE_PATH, halflife=HALFLIFE_SAMPLES):
+        """ Rolling state per parking spot, loaded from path. New states are pending until commit()"""
+        self.path = path
+        self.halflife = halflife
+        self.states = {}
+        self.pending = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get("halflife") == halflife:
+                self.states = saved["states"]
+            else:
+                print(f"Rolling features: half-life changed from {saved.get('halflife')} to {halflife}, starting over")
+
+    def transform(self, psensor, df):
+        """ Returns the new rows of a parking spot in UTC time order, with the rolling features added.
+
+        Continues from the committed state, so a failed cycle that is retried
+        computes the same features again. Rows at or before the last committed row
+        (UTC time and f_cnt) are replays of stored rows, they get missing features
+        and leave the state alone.
+        """
+        df = df.iloc[_time_order(df)] if len(df) else df
+        state = self.states.get(psensor)
+        times = utc_times(df)
+        f_cnt = df['f_cnt'].to_numpy(dtype=np.float64)
+        new = np.ones(len(df), dtype=bool)
+        if state is not None and state.get("until_utc") and len(df):
+            until_time = np.datetime64(state["until_utc"][0], 'us')
+            until_f_cnt = state["until_utc"][1]
+            new = (times > until_time) | ((times == until_time) & (f_cnt > until_f_cnt))
+
+        features, pending = rolling_features(df[new], state, self.halflife)
+        if new.any():
+            last = np.flatnonzero(new)[-1]
+            pending["until_utc"] = [pd.Timestamp(times[last]).isoformat(), float(f_cnt[last])]
+        elif state is not None:
+            pending["until_utc"] = state.get("until_utc")
+        self.pending[psensor] = pending
+        features = features.reindex(df.index)
+        return pd.concat([df.drop(columns=features.columns, errors='ignore'), features], axis=1)
+
+    def commit(self):
+        """ Makes the pending states the committed ones and saves them, call after the rows are stored"""
+        self.states.update(self.pending)
+        self.pending = {}
+        self.save()
+
+    def save(self):
+        """ Writes the states atomically"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"halflife": self.halflife, "states": self.states}, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def check_incremental(df, increments=50, halflife=HALFLIFE_SAMPLES):
+    """ Compares the batch features of a history with feeding the same rows in increments"""
+    import tempfile
+
+    batch = batch_features(df, halflife)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = RollingFeatureEngine(os.path.join(directory, "state.json"), halflife)
+        parts = []
+        for psensor, group in df.groupby('psensor', observed=True, sort=False):
+            group = group.iloc[_time_order(group)]
+            for chunk in np.array_split(np.arange(len(group)), min(increments, len(group))):
+                parts.append(engine.transform(psensor, group.iloc[chunk])[batch.columns])
+                engine.commit()
+                # Reloading the saved state like the next pipeline run does
+                engine = RollingFeatureEngine(engine.path, halflife)
+    incremental = pd.concat(parts).loc[df.index]
+    return bool(np.array_equal(batch.to_numpy(), incremental.to_numpy(), equal_nan=True))
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from backfill import BACKFILL_PATH, load_backfill
+
+    history = load_backfill(path=sys.argv[1] if len(sys.argv) > 1 else BACKFILL_PATH)
+    if history.empty:
+        raise SystemExit("No backfilled rows, run backfill.py first")
+    started = time.perf_counter()
+    features = batch_features(history)
+    print(f"Computed {features.shape[1]} rolling features for {len(history)} rows in {time.perf_counter() - started:.2f} s")
+    print(f"Batch and incremental features identical: {check_incremental(history)}")
@@ -0,0 +1,174 @@
+# Compact integer keys for the sensor rows.
+# The row id used to be `str(time) + '_' + psensor`, a ~30 byte Python string per row.
+# Here the parking spot, the event time in seconds and the frame counter are packed
+# into one int64, so ids are 8 bytes, sort by spot and time and compare as numbers.
+# The time is packed in UTC, the local time repeats for one hour when DST ends:
+#
+#   bit 63     sign, always 0
+#   bits 55-62 sensor index (SENSOR_INDEX, unknown spots are refused)
+#   bits 22-54 seconds since KEY_EPOCH (2020-01-01 UTC, good until the year 2292)
+#   bits 0-21  f_cnt modulo 2**22, separates uplinks within the same second
+#
+# KeyIndex is a sorted array of the keys that are already stored, used to skip
+# re-fetched or replayed rows before they are written to a feature group.
+#
+# Usage: python row_keys.py [n_rows]   (compares string ids and int64 keys)
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from time_utils import utc_times
+
+KEY_INDEX_PATH = os.getenv(
+    "KEY_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "keys"),
+)
+
+KEY_EPOCH = pd.Timestamp("2020-01-01")
+SENSOR_BITS, TIME_BITS, SEQUENCE_BITS = 8, 33, 22
+TIME_SHIFT = SEQUENCE_BITS
+SENSOR_SHIFT = TIME_BITS + SEQUENCE_BITS
+
+# Fixed numbers of the parking spots, never renumber them as they are part of the stored keys.
+# A new spot gets the next free number here before its rows are written.
+SENSOR_INDEX = {"BUILDING": 1, "BIKELANE": 2}
+
+
+def sensor_index(psensor):
+    """ The number of a parking spot in the keys"""
+    if psensor not in SENSOR_INDEX:
+        raise ValueError(f"Unknown parking spot {psensor!r}, add it to SENSOR_INDEX in row_keys.py")
+    return SENSOR_INDEX[psensor]
+
+
+def pack_keys(psensor, times, f_cnt=None):
+    """ int64 keys from a parking spot name (or one per row), event times and frame counters.
+
+    Naive times are taken as UTC and truncated to the second, a missing f_cnt counts as 0.
+    """
+    times = pd.to_datetime(pd.Series(times)).reset_index(drop=True)
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+    seconds = ((times - KEY_EPOCH) // pd.Timedelta(seconds=1)).to_numpy(dtype=np.int64)
+    if len(seconds) and (seconds.min() < 0 or seconds.max() >= 1 << TIME_BITS):
+        raise ValueError(f"Event times must be between {KEY_EPOCH} and the year 2292")
+
+    if isinstance(psensor, str):
+        sensors = np.full(len(seconds), sensor_index(psensor), dtype=np.int64)
+    else:
+        names = pd.Series(psensor).astype(object).reset_index(drop=True)
+        sensors = names.map({name: sensor_index(name) for name in names.unique()}).to_numpy(dtype=np.int64)
+
+    if f_cnt is None:
+        sequence = np.zeros(len(seconds), dtype=np.int64)
+    else:
+        sequence = pd.Series(f_cnt).fillna(0).to_numpy(dtype=np.int64) & ((1 << SEQUENCE_BITS) - 1)
+    return (sensors << SENSOR_SHIFT) | (seconds << TIME_SHIFT) | sequence
+
+
+def row_keys(df):
+    """ The keys of a sensor frame with psensor, time and (optionally) f_cnt columns.
+
+    The local time of normalize_time is turned back into UTC with the time_hour column.
+    """
+    return pack_keys(df['psensor'], utc_times(df), df['f_cnt'] if 'f_cnt' in df.columns else None)
+
+
+def unpack_keys(keys):
+    """ A frame with the sensor index, UTC event time and f_cnt (modulo 2**22) of each key, for debugging"""
+    keys = np.asarray(keys, dtype=np.int64)
+    return pd.DataFrame({
+        'sensor_index': keys >> SENSOR_SHIFT,
+        'time': KEY_EPOCH + pd.to_timedelta((keys >> TIME_SHIFT) & ((1 << TIME_BITS) - 1), unit="s"),
+        'f_cnt': keys & ((1 << SEQUENCE_BITS) - 1),
+    })
+
+
+class KeyIndex(object):
+
+    def __init__(self, keys=()):
+        """ Set of int64 keys as a sorted array, membership of a batch is one np.searchsorted"""
+        self.keys = np.unique(np.asarray(keys, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return bool(self.contains([key])[0])
+
+    def contains(self, keys):
+        """ Boolean array, True for the keys that are in the index"""
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+    def add(self, keys):
+        """ Adds keys to the index. Returns self"""
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(keys):
+            self.keys = np.union1d(self.keys, keys)
+        return self
+
+    def new_rows(self, df, column='id'):
+        """ The rows of df whose key is not in the index, the first row of keys repeated within df"""
+        keys = df[column].to_numpy(dtype=np.int64)
+        return df[~self.contains(keys) & ~pd.Series(keys).duplicated().to_numpy()]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, self.keys)
+        os.replace(path + ".tmp", path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a saved index, an empty one if there is none yet"""
+        if not os.path.exists(path):
+            return cls()
+        index = cls()
+        index.keys = np.load(path)
+        return index
+
+
+def key_index_path(name, path=KEY_INDEX_PATH):
+    """ Where the index of the stored keys of a feature group is kept, e.g. state/keys/new_building_fg.npy"""
+    return os.path.join(path, f"{name}.npy")
+
+
+def benchmark(n_rows=200_000, seed=0):
+    """ Prints memory, dedupe and join time of string ids and int64 keys for the same rows"""
+    import time
+
+    rng = np.random.default_rng(seed)
+    times = pd.Series(KEY_EPOCH + pd.Timedelta(days=1550)
+                      + pd.to_timedelta(np.sort(rng.integers(0, 61 * 24 * 3600, n_rows)), unit="s"))
+    df = pd.DataFrame({'time': times, 'psensor': rng.choice(list(SENSOR_INDEX), n_rows),
+                       'f_cnt': np.arange(n_rows)})
+    ids = {"string ids": df['time'].astype(str) + '_' + df['psensor'], "int64 keys": pd.Series(row_keys(df))}
+    # Half the rows are replayed, like a re-fetched API range
+    for name, id_column in ids.items():
+        replay = pd.concat([id_column, id_column.iloc[: n_rows // 2]], ignore_index=True)
+        start = time.perf_counter()
+        replay.drop_duplicates()
+        dedupe = time.perf_counter() - start
+        start = time.perf_counter()
+        pd.DataFrame({'id': id_column}).merge(pd.DataFrame({'id': replay}), on='id')
+        join = time.perf_counter() - start
+        print(f"{name:>11}: {id_column.memory_usage(deep=True) / 1e6:.1f} MB, "
+              f"dedupe {dedupe * 1e3:.0f} ms, join {join * 1e3:.0f} ms for {n_rows} rows")
+    index = KeyIndex(ids["int64 keys"].iloc[: n_rows // 2])
+    start = time.perf_counter()
+    index.contains(ids["int64 keys"])
+    print(f"{'KeyIndex':>11}: {len(index)} keys, lookup of {n_rows} keys in "
+          f"{(time.perf_counter() - start) * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,197 @@
+# Shared access layer for the Sensade sensor API.
+# Used by the feature pipelines to fetch data for many sensors at once.
+
+import base64
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+# Defining API information
+url = "https://data.sensade.com"
+
+# The sensors we have access to, dev_eui -> parking spot name
+SENSORS = {
+    "0080E115003BEA91": "BUILDING",
+    "0080E115003E3597": "BIKELANE",
+}
+
+# Location of the sensors (latitude, longitude), used to look up the weather
+SENSOR_LOCATIONS = {
+    "0080E115003BEA91": (57.01, 9.99),
+    "0080E115003E3597": (57.01, 9.99),
+}
+DEFAULT_LOCATION = (57.01, 9.99)
+
+# Defaults for the concurrent fetcher
+MAX_WORKERS = 16
+TIMEOUT = (5, 60)  # (connect, read) in seconds
+
+# Rows parsed at a time when streaming a response
+CHUNK_SIZE = 50_000
+
+# API_call keeps the whole response in memory, so it only takes ranges up to this long.
+# Longer ranges are read chunk by chunk with API_call_stream (see backfill.py)
+MAX_CALL_RANGE = pd.Timedelta(days=float(os.getenv("API_CALL_MAX_DAYS", 3)))
+
+# Renaming the radar columns to start with radar to deal with hopsworks problem
+RADAR_RENAMES = {f'{i}_radar': f'radar_{i}' for i in range(8)}
+
+# Column types of the CSV returned by the API, applied while parsing
+SENSOR_SCHEMA = {
+    'time': str,
+    'battery': 'float64',
+    'temperature': 'float64',
+    'x': 'float64',
+    'y': 'float64',
+    'z': 'float64',
+    **{radar: 'float64' for radar in RADAR_RENAMES},
+    'package_type': str,
+    'f_cnt': 'float64',
+    'dr': 'float64',
+    'snr': 'float64',
+    'rssi': 'float64',
+    'hw_fw_version': str,
+}
+
+
+def get_headers():
+    """ Builds the basic auth headers from the API_USERNAME/API_PASSWORD environment variables"""
+    basic_auth = base64.b64encode(f"{os.getenv('API_USERNAME')}:{os.getenv('API_PASSWORD')}".encode())
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': f'Basic {basic_auth.decode("utf-8")}'
+    }
+
+
+def get_dev_euis():
+    """ Returns the dev_euis to poll, either from SENSOR_DEV_EUIS (comma separated) or the known sensors"""
+    dev_euis = os.getenv("SENSOR_DEV_EUIS")
+    if dev_euis:
+        return [dev_eui.strip() for dev_eui in dev_euis.split(",") if dev_eui.strip()]
+    return list(SENSORS)
+
+
+def get_location(dev_eui):
+    """ Returns the (latitude, longitude) of a sensor"""
+    return SENSOR_LOCATIONS.get(dev_eui, DEFAULT_LOCATION)
+
+
+def create_session(max_workers=MAX_WORKERS):
+    """ Creates a keep-alive session with a connection pool big enough for all workers"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(get_headers())
+    return session
+
+
+class SensorFetchError(Exception):
+    """ Raised when the API does not return data for a sensor"""
+
+    def __init__(self, dev_eui, message):
+        super().__init__(f"{dev_eui}: {message}")
+        self.dev_eui = dev_eui
+
+
+def _request(dev_eui, from_date, to_date, session, timeout, stream=False):
+    """ Sends the GET request for a sensor and raises SensorFetchError on a non-200 response"""
+    payload = json.dumps({
+    "dev_eui": dev_eui,
+    "from": from_date,
+    "to": to_date
+})
+
+    if session is None:
+        API_response = requests.request("GET", url, headers=get_headers(), data=payload, timeout=timeout, stream=stream)
+    else:
+        API_response = session.request("GET", url, data=payload, timeout=timeout, stream=stream)
+
+    if API_response.status_code != 200:
+        API_response.close()
+        raise SensorFetchError(dev_eui, f"API returned status {API_response.status_code}")
+
+    return API_response
+
+
+def API_call_stream(dev_eui, from_date, to_date, session=None, timeout=TIMEOUT, chunksize=CHUNK_SIZE):
+    """ Streams the API response and yields typed DataFrames of at most chunksize rows.
+
+    The body is parsed straight from the socket with SENSOR_SCHEMA and the radar
+    columns renamed, so memory is bounded by the chunk size and not by the
+    length of the requested time range.
+    """
+    with _request(dev_eui, from_date, to_date, session, timeout, stream=True) as API_response:
+        API_response.raw.decode_content = True
+        try:
+            reader = pd.read_csv(API_response.raw, dtype=SENSOR_SCHEMA, chunksize=chunksize)
+        except pd.errors.EmptyDataError:
+            return
+        with reader:
+            for chunk in reader:
+                yield chunk.rename(columns=RADAR_RENAMES)
+
+
+# Function to ping the API and get data in a given time interval
+def API_call(dev_eui, from_date, to_date, session=None, timeout=TIMEOUT):
+    """ The rows of a short time range as one DataFrame.
+
+    Ranges longer than MAX_CALL_RANGE raise ValueError, use API_call_stream for those.
+    """
+    if pd.Timestamp(to_date) - pd.Timestamp(from_date) > MAX_CALL_RANGE:
+        raise ValueError(f"{from_date} to {to_date} is longer than {MAX_CALL_RANGE}, use API_call_stream")
+    chunks = list(API_call_stream(dev_eui, from_date, to_date, session, timeout))
+    if not chunks:
+        return pd.DataFrame(columns=[RADAR_RENAMES.get(column, column) for column in SENSOR_SCHEMA])
+    df = pd.concat(chunks, ignore_index=True)
+    return df
+
+
+def fetch_sensors(dev_euis, from_date, to_date, session=None, max_workers=MAX_WORKERS, timeout=TIMEOUT):
+    """ Fetches all sensors concurrently for the same time interval, see fetch_sensor_ranges"""
+    ranges = {dev_eui: (from_date, to_date) for dev_eui in dev_euis}
+    return fetch_sensor_ranges(ranges, session, max_workers, timeout)
+
+
+def fetch_sensor_ranges(ranges, session=None, max_workers=MAX_WORKERS, timeout=TIMEOUT):
+    """ Fetches a dict of dev_eui -> (from_date, to_date) concurrently over one pooled session.
+
+    Returns a dict of dev_eui -> DataFrame for the sensors that succeeded and a
+    dict of dev_eui -> error message for the ones that failed, so a single broken
+    sensor does not stop the others.
+    """
+    results, failures = {}, {}
+    if not ranges:
+        return results, failures
+
+    own_session = session is None
+    if own_session:
+        session = create_session(max_workers)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(ranges))) as executor:
+            futures = {
+                executor.submit(API_call, dev_eui, from_date, to_date, session, timeout): dev_eui
+                for dev_eui, (from_date, to_date) in ranges.items()
+            }
+            for future in as_completed(futures):
+                dev_eui = futures[future]
+                try:
+                    results[dev_eui] = future.result()
+                except (SensorFetchError, requests.RequestException, ValueError) as e:
+                    failures[dev_eui] = str(e)
+    finally:
+        if own_session:
+            session.close()
+
+    return results, failures
+
+
+def report_failures(failures):
+    """ Prints one line per failed sensor"""
+    for dev_eui, error in sorted(failures.items()):
+        print(f"Failed to fetch sensor {dev_eui}: {error}")
@@ -0,0 +1,130 @@
+# Compact in-memory representation of the sensor frames.
+# The sensor channels and weather variables are kept as float32, the parking spot and the
+# firmware/package columns as categoricals and the labels as a nullable categorical
+# ('detection'/'no_detection', missing labels are NaN instead of the string "null").
+# Casts and fills work on whole column blocks in place, without extra copies of the frame.
+#
+# Usage: python sensor_frames.py [path/to/historic.csv ...]   (memory benchmark)
+
+import numpy as np
+import pandas as pd
+
+from sensor_api import SENSORS
+from weather_store import WEATHER_VARIABLES
+
+RADAR_COLUMNS = ['radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7']
+SENSOR_CHANNELS = ['battery', 'temperature', 'x', 'y', 'z'] + RADAR_COLUMNS + ['dr', 'snr', 'rssi']
+FLOAT32_COLUMNS = SENSOR_CHANNELS + WEATHER_VARIABLES
+
+# Columns that are backfilled in the full historic frame
+BACKFILL_COLUMNS = RADAR_COLUMNS + ['battery']
+
+LABEL_COLUMNS = ['mag_cluster', 'radar_cluster']
+LABEL_DTYPE = pd.CategoricalDtype(['detection', 'no_detection'])
+# Open categories, parking spots that are not in SENSORS keep their name
+CATEGORY_COLUMNS = ['psensor', 'package_type', 'hw_fw_version']
+
+
+def _present(df, columns):
+    return [c for c in columns if c in df.columns]
+
+
+def compact_frame(df):
+    """ Casts the columns of a sensor frame to the compact dtypes, in place. Returns df.
+
+    Every group of columns is cast with one assignment of the whole block.
+    Label columns holding the legacy "null" placeholder become missing values.
+    """
+    floats = [c for c in _present(df, FLOAT32_COLUMNS) if df[c].dtype != np.float32]
+    if floats:
+        df[floats] = df[floats].astype(np.float32)
+    for column in _present(df, CATEGORY_COLUMNS):
+        if not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    for column in _present(df, LABEL_COLUMNS):
+        if df[column].dtype != LABEL_DTYPE:
+            df[column] = label_column(df[column].replace("null", np.nan), df.index)
+    return df
+
+
+def label_column(labels, index=None):
+    """ A nullable categorical label column from 'detection'/'no_detection' values (NaN/None for no label)"""
+    return pd.Series(pd.Categorical(np.asarray(labels, dtype=object), dtype=LABEL_DTYPE), index=index)
+
+
+def add_empty_labels(df):
+    """ Adds the label columns with only missing values, in place"""
+    for column in LABEL_COLUMNS:
+        df[column] = label_column(np.full(len(df), np.nan, dtype=object), df.index)
+    return df
+
+
+def backfill(df, columns=BACKFILL_COLUMNS):
+    """ Backfills the columns with the next value, in one operation over the block"""
+    columns = _present(df, columns)
+    df[columns] = df[columns].bfill()
+    return df
+
+
+def storage_frame(df):
+    """ A copy with the dtypes of the feature groups: float64 and string columns, missing labels as nulls.
+
+    float32 values widen exactly, e.g. 3.2 is stored as 3.2000000476837.
+    """
+    out = df.copy()
+    floats = list(out.select_dtypes(include=[np.float32]).columns)
+    if floats:
+        out[floats] = out[floats].astype(np.float64)
+    for column in out.columns:
+        if isinstance(out[column].dtype, pd.CategoricalDtype):
+            # The string dtype keeps the column typed even when every label is missing
+            out[column] = out[column].astype("string")
+    return out
+
+
+def memory_usage(df):
+    """ Bytes used by a frame, including the Python strings in object columns"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _synthetic_frame(n_rows, seed=0):
+    """ A preprocessed historic frame: API columns, weather, id, time_hour and labels"""
+    rng = np.random.default_rng(seed)
+    times = pd.Timestamp("2024-03-01") + pd.to_timedelta(np.sort(rng.integers(0, 61 * 24 * 3600, n_rows)), unit="s")
+    df = pd.DataFrame({c: rng.normal(0, 100, n_rows).round(1) for c in SENSOR_CHANNELS + WEATHER_VARIABLES})
+    df['f_cnt'] = np.arange(n_rows, dtype=np.float64)
+    df['package_type'] = rng.choice(['status', 'measurement'], n_rows)
+    df['hw_fw_version'] = '1.4.2'
+    df['time'] = times
+    df['time_hour'] = times.floor('h')
+    df['psensor'] = rng.choice(sorted(set(SENSORS.values())), n_rows)
+    df['id'] = df['time'].astype(str) + '_' + df['psensor']
+    df['mag_cluster'] = rng.choice(['detection', 'no_detection'], n_rows)
+    df['radar_cluster'] = "null"
+    return df
+
+
+def benchmark(df=None, n_rows=200_000):
+    """ Prints the memory of a frame with the default dtypes and after compact_frame"""
+    if df is None:
+        df = _synthetic_frame(n_rows)
+    before = memory_usage(df)
+    compact = compact_frame(df.copy())
+    after = memory_usage(compact)
+    print(f"{'default dtypes':>15}: {before / 1e6:.1f} MB for {len(df)} rows")
+    print(f"{'compact':>15}: {after / 1e6:.1f} MB")
+    print(f"{'reduction':>15}: {before / after:.1f}x")
+    return before, after
+
+
+if __name__ == "__main__":
+    import sys
+
+    from sensor_api import RADAR_RENAMES
+
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            print(path)
+            benchmark(pd.read_csv(path).rename(columns=RADAR_RENAMES))
+    else:
+        benchmark()
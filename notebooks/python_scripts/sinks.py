@@ -0,0 +1,155 @@
+# Sinks for writing rows to feature groups, and a write-behind buffer in front of them.
+# The buffer collects the small per-cycle frames and writes them in a few large
+# inserts, so every pipeline cycle does not start its own ingestion job.
+
+import glob
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+SPILL_PATH = os.getenv(
+    "WRITE_BEHIND_SPILL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "write_behind"),
+)
+# Flush a feature group when it has this many rows buffered or its oldest row is this old
+MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", 1000))
+MAX_AGE_SECONDS = float(os.getenv("WRITE_BEHIND_MAX_AGE_SECONDS", 900))
+
+
+class HopsworksSink(object):
+
+    def __init__(self, get_feature_group):
+        """ Writes to Hopsworks, get_feature_group(name) returns the feature group to insert into"""
+        self.get_feature_group = get_feature_group
+        self.feature_groups = {}
+
+    def write(self, name, df):
+        if name not in self.feature_groups:
+            self.feature_groups[name] = self.get_feature_group(name)
+        self.feature_groups[name].insert(df)
+
+
+class LocalFileSink(object):
+
+    def __init__(self, directory):
+        """ Writes every flush as a Parquet file in directory/<feature group name>/, for offline use and testing"""
+        self.directory = directory
+
+    def write(self, name, df):
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+        df.to_parquet(os.path.join(path, f"{time.time_ns()}-{uuid.uuid4().hex}.parquet"), index=False)
+
+    def read(self, name, primary_key="id"):
+        """ Reads all rows of a feature group, keeping the last written row per primary key"""
+        files = sorted(glob.glob(os.path.join(self.directory, name, "*.parquet")))
+        if not files:
+            return pd.DataFrame()
+        df = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+        if primary_key:
+            df = df.drop_duplicates(subset=primary_key, keep="last", ignore_index=True)
+        return df
+
+
+class WriteBehindBuffer(object):
+
+    def __init__(self, sink, max_rows=MAX_ROWS, max_age=MAX_AGE_SECONDS, spill_path=SPILL_PATH,
+                 max_retries=3, retry_backoff=1.0):
+        """ Buffers rows per feature group in front of a sink.
+
+        Every added frame is first written to a spill file, so buffered rows
+        survive a restart and are picked up again by the next buffer. A feature
+        group is flushed when it reaches max_rows or its oldest rows reach
+        max_age seconds. The spill files are removed once the sink accepted them.
+        """
+        self.sink = sink
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.spill_path = spill_path
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.lock = threading.RLock()
+        # name -> list of (added_at, DataFrame, spill file)
+        self.buffers = {}
+        self._load_spill()
+
+    def _load_spill(self):
+        """ Restores the rows that were buffered but not flushed before the last shutdown"""
+        for path in sorted(glob.glob(os.path.join(self.spill_path, "*", "*.parquet"))):
+            name = os.path.basename(os.path.dirname(path))
+            # Using the file time, so restored rows keep counting towards max_age
+            added_at = min(time.time(), os.path.getmtime(path))
+            self.buffers.setdefault(name, []).append((added_at, pd.read_parquet(path), path))
+
+    def _spill(self, name, df):
+        path = os.path.join(self.spill_path, name)
+        os.makedirs(path, exist_ok=True)
+        spill_file = os.path.join(path, f"{time.time_ns()}-{uuid.uuid4().hex}.parquet")
+        tmp_file = spill_file + ".tmp"
+        df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, spill_file)
+        return spill_file
+
+    def buffered_rows(self, name=None):
+        """ Number of buffered rows for one feature group or all of them"""
+        with self.lock:
+            names = [name] if name else list(self.buffers)
+            return sum(len(df) for name in names for _, df, _ in self.buffers.get(name, []))
+
+    def add(self, name, df):
+        """ Buffers the rows for a feature group and flushes it if it is full"""
+        if df.empty:
+            return
+        with self.lock:
+            spill_file = self._spill(name, df)
+            self.buffers.setdefault(name, []).append((time.time(), df, spill_file))
+            if self.buffered_rows(name) >= self.max_rows:
+                self.flush(name)
+
+    def flush_due(self):
+        """ Flushes the feature groups whose oldest buffered rows are older than max_age"""
+        now = time.time()
+        with self.lock:
+            due = [name for name, entries in self.buffers.items()
+                   if entries and now - entries[0][0] >= self.max_age]
+        return all([self.flush(name) for name in due])
+
+    def flush(self, name=None):
+        """ Writes the buffered rows of one or all feature groups to the sink in one insert each.
+
+        Failed writes are retried with exponential backoff. If the sink still fails
+        the rows stay buffered (and spilled) for the next flush. Returns True if
+        everything was written.
+        """
+        if name is None:
+            with self.lock:
+                names = list(self.buffers)
+            return all([self.flush(name) for name in names])
+
+        with self.lock:
+            entries = self.buffers.get(name, [])
+            if not entries:
+                return True
+            df = pd.concat([entry[1] for entry in entries], ignore_index=True)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.sink.write(name, df)
+                    break
+                except Exception as e:
+                    print(f"Writing {len(df)} rows to {name} failed (attempt {attempt + 1}): {e!r}", flush=True)
+                    if attempt == self.max_retries:
+                        return False
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+
+            self.buffers[name] = []
+            for _, _, spill_file in entries:
+                if os.path.exists(spill_file):
+                    os.remove(spill_file)
+            return True
+
+    def close(self):
+        """ Flushes everything, rows that could not be written stay in the spill files"""
+        return self.flush()
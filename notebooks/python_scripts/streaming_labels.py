@@ -0,0 +1,186 @@
+# Streaming labelling of the sensor data.
+# The historic pipeline labels rows with StandardScaler + KMeans(n_clusters=2) over the
+# whole history in memory. Here the history is read chunk by chunk, so it never has to be
+# in memory at once: a first pass fits the scaler statistics (StandardScaler.partial_fit)
+# and keeps a random sample of the rows, the scaler is then frozen, the two clusters are
+# started from a full KMeans on the sample and refined with several MiniBatchKMeans epochs
+# over all chunks. Which cluster means 'detection' is decided once, when the clusters are
+# started, and saved with the labeller, so labels stay consistent across runs and updates.
+#
+# Usage: python streaming_labels.py building_mag mag_cluster building.csv labelled.csv [--chunksize 50000]
+
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+LABELLER_PATH = os.getenv(
+    "LABELLER_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "labellers"),
+)
+CHUNK_SIZE = 50_000
+# Rows the clusters are started from and passes of MiniBatchKMeans over the chunks
+SAMPLE_SIZE = 20_000
+EPOCHS = 5
+
+# The features each label is clustered on, like in 1_historic_api_feature_pipeline
+LABEL_FEATURES = {
+    "mag_cluster": ["x", "y", "z"],
+    "radar_cluster": ['radar_0', 'radar_1', 'radar_2', 'radar_3', 'radar_4', 'radar_5', 'radar_6', 'radar_7'],
+}
+
+
+class StreamingLabeller(object):
+
+    def __init__(self, features, random_state=0, batch_size=1024):
+        """ Two clusters on standardized features, fitted incrementally"""
+        self.features = list(features)
+        self.random_state = random_state
+        self.batch_size = batch_size
+        self.scaler = StandardScaler()
+        self.scaler_frozen = False
+        self.kmeans = None
+        self.detection_cluster = None
+        self.n_seen = 0
+
+    def _valid(self, chunk):
+        X = chunk[self.features].to_numpy(dtype=np.float64)
+        return X, ~np.isnan(X).any(axis=1)
+
+    def fit_scaler(self, chunk):
+        """ Updates the scaler statistics with a chunk of rows, until the scaler is frozen"""
+        if self.scaler_frozen:
+            raise ValueError("The scaler is frozen once the clusters are started")
+        X, valid = self._valid(chunk)
+        if valid.any():
+            self.scaler.partial_fit(X[valid])
+        return self
+
+    def start_clusters(self, sample):
+        """ Freezes the scaler and starts the clusters from a full KMeans on a sample of rows"""
+        X, valid = self._valid(sample)
+        X = X[valid]
+        if len(X) < 2:
+            raise ValueError("At least 2 rows without missing features are needed to start the clusters")
+        if not hasattr(self.scaler, "mean_"):
+            self.scaler.partial_fit(X)
+        self.scaler_frozen = True
+        # The same KMeans as the full-history labelling, so a sample of the whole history
+        # gives the same clusters
+        centers = KMeans(n_clusters=2, random_state=self.random_state).fit(self.scaler.transform(X)).cluster_centers_
+        self.kmeans = MiniBatchKMeans(n_clusters=2, init=centers, n_init=1, random_state=self.random_state,
+                                      batch_size=self.batch_size)
+        self.kmeans.partial_fit(centers)
+        # The cluster furthest from the mean of the standardized data is the deviation from
+        # the empty spot, i.e. a detection. Fixed from here on, so labels never flip
+        self.detection_cluster = int(np.linalg.norm(centers, axis=1).argmax())
+        return self
+
+    def partial_fit(self, chunk):
+        """ Updates the clusters with a chunk of rows, scaled with the frozen scaler.
+
+        Without clusters yet (data that arrives over time), the scaler and the
+        clusters are started from the chunk itself.
+        """
+        X, valid = self._valid(chunk)
+        if self.kmeans is None:
+            if valid.sum() < 2:
+                # Not enough rows to start the two clusters
+                return self
+            self.start_clusters(chunk)
+        X = X[valid]
+        if len(X) == 0:
+            return self
+        self.kmeans.partial_fit(self.scaler.transform(X))
+        self.n_seen += len(X)
+        return self
+
+    def predict(self, chunk):
+        """ 'detection'/'no_detection' per row, NaN for rows with missing features or before the first fit"""
+        X, valid = self._valid(chunk)
+        labels = np.full(len(chunk), np.nan, dtype=object)
+        if self.detection_cluster is None or not valid.any():
+            return labels
+        clusters = self.kmeans.predict(self.scaler.transform(X[valid]))
+        labels[valid] = np.where(clusters == self.detection_cluster, 'detection', 'no_detection')
+        return labels
+
+    def update(self, chunk):
+        """ Fits the new chunk and returns its labels, for data that arrives over time"""
+        return self.partial_fit(chunk).predict(chunk)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(self, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return path
+
+
+def labeller_path(name, path=LABELLER_PATH):
+    return os.path.join(path, f"{name}.joblib")
+
+
+def get_labeller(name, label, path=LABELLER_PATH):
+    """ Loads the saved labeller of e.g. building_mag, or creates a new one for the label's features"""
+    if os.path.exists(labeller_path(name, path)):
+        return joblib.load(labeller_path(name, path))
+    return StreamingLabeller(LABEL_FEATURES[label])
+
+
+def iter_chunks(df, chunksize=CHUNK_SIZE):
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+def label_frame(df, labeller, chunksize=CHUNK_SIZE, epochs=EPOCHS, sample_size=SAMPLE_SIZE):
+    """ Labels a frame in chunks. The scaler is fitted in a first pass, then the clusters in
+    several passes over all chunks, so every row is labelled with the same clusters, like
+    the full-history KMeans did.
+    """
+    if not len(df):
+        return np.array([], dtype=object)
+    rng = np.random.default_rng(labeller.random_state)
+    fraction = min(1.0, sample_size / len(df))
+    samples = []
+    for chunk in iter_chunks(df, chunksize):
+        labeller.fit_scaler(chunk)
+        # A random sample of the rows, kept in their order
+        samples.append(chunk[rng.random(len(chunk)) < fraction] if fraction < 1 else chunk)
+    labeller.start_clusters(pd.concat(samples))
+    for _ in range(epochs):
+        for chunk in iter_chunks(df, chunksize):
+            # Mini-batches of the labeller's batch size in random order within each chunk
+            for batch in np.array_split(rng.permutation(len(chunk)), max(1, len(chunk) // labeller.batch_size)):
+                labeller.partial_fit(chunk.iloc[batch])
+    return np.concatenate([labeller.predict(chunk) for chunk in iter_chunks(df, chunksize)])
+
+
+def label_stream(chunks, labeller, label):
+    """ Labels chunks as they arrive (e.g. from sensor_api.API_call_stream), updating the clusters with each"""
+    for chunk in chunks:
+        chunk = chunk.copy()
+        chunk[label] = labeller.update(chunk)
+        yield chunk
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Labels a CSV file chunk by chunk with a saved streaming labeller")
+    parser.add_argument("name", help="Name of the labeller, e.g. building_mag")
+    parser.add_argument("label", choices=sorted(LABEL_FEATURES))
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    labeller = get_labeller(args.name, args.label)
+    rows = 0
+    for i, chunk in enumerate(label_stream(pd.read_csv(args.input, chunksize=args.chunksize), labeller, args.label)):
+        chunk.to_csv(args.output, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        rows += len(chunk)
+    labeller.save(labeller_path(args.name))
+    print(f"Labelled {rows} rows, the labeller has seen {labeller.n_seen} rows")
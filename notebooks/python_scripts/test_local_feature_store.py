@@ -0,0 +1,40 @@
+# Checks the filters of the local feature store backend.
+#
+# Usage: python -m pytest test_local_feature_store.py
+
+import pandas as pd
+import pytest
+
+from local_feature_store import LocalFeatureStore
+
+
+@pytest.fixture
+def fg(tmp_path):
+    fg = LocalFeatureStore(str(tmp_path)).get_or_create_feature_group("t", 1, primary_key=["id"], event_time="time")
+    fg.insert(pd.DataFrame({
+        "id": range(6),
+        "time": pd.date_range("2024-01-01", periods=6, freq="h"),
+        "time_utc": pd.date_range("2024-01-01", periods=6, freq="h", tz="UTC"),
+        "psensor": ["A", "B"] * 3,
+        "x": range(6),
+    }))
+    return fg
+
+
+def test_chained_filters(fg):
+    query = fg.select_all().filter((fg["x"] > 0) & (fg["x"] < 5) & (fg["psensor"] == "A"))
+    assert query.read()["id"].tolist() == [2, 4]
+    assert query.to_string() == "SELECT * FROM t_1 WHERE x > 0 AND x < 5 AND psensor == 'A'"
+
+
+def test_feature_view_keeps_chained_filters(fg):
+    fs = fg.store
+    fs.create_feature_view("v", fg.select(["id", "x"]).filter((fg["x"] >= 2) & (fg["x"] <= 3) & (fg["x"] != 2)))
+    assert fs.get_feature_view("v").get_batch_data()["id"].tolist() == [3]
+
+
+def test_timestamp_filters_on_tz_aware_columns(fg):
+    assert fg.filter(fg["time_utc"] >= pd.Timestamp("2024-01-01 04:00")).read()["id"].tolist() == [4, 5]
+    # 04:00 in Copenhagen is 03:00 UTC
+    aware = pd.Timestamp("2024-01-01 04:00", tz="Europe/Copenhagen")
+    assert fg.filter(fg["time_utc"] >= aware).read()["id"].tolist() == [3, 4, 5]
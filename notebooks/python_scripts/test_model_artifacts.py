@@ -0,0 +1,52 @@
+# Checks that the memory-mapped artifacts of model_artifacts.py predict like the pickled models.
+#
+# Usage: python -m pytest test_model_artifacts.py
+
+import os
+import warnings
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+from model_artifacts import MmapKNN, save_knn_artifact
+
+MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+MODEL_NAMES = ["building_mag_hist_model", "bikelane_mag_hist_model", "building_rad_hist_model", "bikelane_rad_hist_model"]
+
+
+def check_artifact(model, X, directory):
+    artifact = MmapKNN(save_knn_artifact(model, directory, "model"))
+    expected_distances, expected_indices = model.kneighbors(X)
+    distances, indices = artifact.kneighbors(X)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-9, atol=1e-9)
+    assert np.array_equal(artifact.predict(X), model.predict(X))
+    # Neighbours at the same distance may come in another order, the distances may not
+    assert (indices == expected_indices).mean() > 0.99
+
+
+@pytest.mark.parametrize("weights", ["uniform", "distance"])
+def test_artifact_matches_sklearn(tmp_path, weights):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(5000, 5))
+    y = np.where(X[:, 0] + 0.3 * rng.normal(size=len(X)) > 0, "detection", "no_detection")
+    model = KNeighborsClassifier(n_neighbors=3, weights=weights).fit(X, y)
+    check_artifact(model, rng.normal(size=(700, 5)), str(tmp_path))
+
+
+@pytest.mark.parametrize("name", MODEL_NAMES)
+def test_artifact_matches_stored_model(tmp_path, name):
+    path = os.path.join(MODELS_PATH, name + ".pkl")
+    if not os.path.exists(path):
+        pytest.skip(f"No stored model {path}")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = joblib.load(path)
+    X = np.asarray(model._fit_X)
+    rng = np.random.default_rng(0)
+    queries = X[rng.choice(len(X), 500)] + rng.normal(scale=X.std(axis=0) * 0.05, size=(500, X.shape[1]))
+    with warnings.catch_warnings():
+        # The stored models were fitted with feature names
+        warnings.simplefilter("ignore")
+        check_artifact(model, queries, str(tmp_path))
@@ -0,0 +1,41 @@
+# Checks that the serving entry point answers with plain, JSON serializable labels.
+#
+# Usage: python -m pytest test_predict_example.py
+
+import json
+import os
+import warnings
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+from predict_example import Predict
+
+MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+
+
+def test_predict_with_string_labels(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, 5))
+    y = np.where(X[:, 0] > 0, "detection", "no_detection").astype(object)
+    model = KNeighborsClassifier(n_neighbors=2).fit(X, y)
+    joblib.dump(model, tmp_path / "string_model.pkl")
+
+    predictor = Predict("string_model", str(tmp_path))
+    for x in X[:20]:
+        prediction = predictor.predict(x.tolist())
+        assert prediction == model.predict(x.reshape(1, -1)).tolist()
+        assert json.loads(json.dumps(prediction)) == prediction
+
+
+def test_predict_with_stored_model():
+    if not os.path.exists(os.path.join(MODELS_PATH, "building_mag_hist_model.pkl")):
+        pytest.skip("No stored building_mag_hist_model")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        predictor = Predict("building_mag_hist_model", MODELS_PATH)
+    prediction = predictor.predict([1.0, 2.0, 3.0, 10.0, 0.1])
+    assert prediction[0] in ("detection", "no_detection")
+    assert isinstance(prediction[0], str)
@@ -0,0 +1,44 @@
+# Checks the int64 row keys of row_keys.py.
+#
+# Usage: python -m pytest test_row_keys.py
+
+import pandas as pd
+import pytest
+
+from row_keys import KeyIndex, row_keys, unpack_keys
+from time_utils import normalize_time
+
+
+def sensor_frame(times, psensor="BUILDING"):
+    df = pd.DataFrame({'time': times, 'f_cnt': range(len(times))})
+    normalize_time(df)
+    df['psensor'] = psensor
+    return df
+
+
+def test_keys_are_unique_when_dst_ends():
+    # 00:30 and 01:30 UTC are both 02:30 local time on the night DST ends
+    df = sensor_frame(["2024-10-27T00:30:00Z", "2024-10-27T01:30:00Z"])
+    df['f_cnt'] = 7
+    assert df['time'].nunique() == 1
+    keys = row_keys(df)
+    assert keys[0] != keys[1]
+    assert list(unpack_keys(keys)['time']) == [pd.Timestamp("2024-10-27 00:30"), pd.Timestamp("2024-10-27 01:30")]
+
+
+def test_keys_are_utc():
+    df = sensor_frame(["2024-07-01T12:00:00Z"])
+    assert unpack_keys(row_keys(df))['time'][0] == pd.Timestamp("2024-07-01 12:00")
+
+
+def test_unknown_spot_is_refused():
+    with pytest.raises(ValueError):
+        row_keys(sensor_frame(["2024-07-01T12:00:00Z"], psensor="0080E115003BEA91"))
+
+
+def test_key_index_skips_stored_and_repeated_rows():
+    df = sensor_frame(["2024-07-01T12:00:00Z", "2024-07-01T12:01:00Z", "2024-07-01T12:02:00Z"])
+    df['id'] = row_keys(df)
+    index = KeyIndex(df['id'][:1])
+    new = index.new_rows(pd.concat([df, df.iloc[[2]]], ignore_index=True))
+    assert list(new['f_cnt']) == [1, 2]
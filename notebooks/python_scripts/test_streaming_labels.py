@@ -0,0 +1,90 @@
+# Checks that the chunked labelling of streaming_labels.py agrees with the full-history
+# StandardScaler + KMeans labelling of 1_historic_api_feature_pipeline.
+#
+# Usage: python -m pytest test_streaming_labels.py
+
+import os
+import warnings
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import KMeans
+from sklearn.preprocessing import StandardScaler
+
+from streaming_labels import LABEL_FEATURES, StreamingLabeller, label_frame, label_stream, iter_chunks
+
+MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+MIN_AGREEMENT = 0.95
+
+
+def full_kmeans_labels(df, features):
+    """ The labels of the full-history KMeans, True for 'detection', the cluster furthest from the mean"""
+    X = StandardScaler().fit_transform(df[features])
+    kmeans = KMeans(n_clusters=2, random_state=0).fit(X)
+    return kmeans.labels_ == np.linalg.norm(kmeans.cluster_centers_, axis=1).argmax()
+
+
+def agreement(labels, detections):
+    """ Share of rows with the same label, 'detection' has to be the same cluster in both"""
+    return np.mean((labels == 'detection') == detections)
+
+
+def synthetic_frame(n_rows=60_000, occupied=0.3, seed=0):
+    """ Magnetic readings of an empty spot with a shifted field while a car is parked"""
+    rng = np.random.default_rng(seed)
+    parked = rng.random(n_rows) < occupied
+    xyz = rng.normal(0, 20, (n_rows, 3)) + np.where(parked[:, None], [120.0, -80.0, 40.0], 0.0)
+    return pd.DataFrame(xyz, columns=LABEL_FEATURES["mag_cluster"])
+
+
+def stored_frame(name):
+    """ The training rows kept in a stored KNN model, e.g. building_mag"""
+    path = os.path.join(MODELS_PATH, f"{name}_hist_model.pkl")
+    if not os.path.exists(path):
+        pytest.skip(f"No stored model {path}")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = joblib.load(path)
+    return pd.DataFrame(model._fit_X, columns=model.feature_names_in_)
+
+
+@pytest.mark.parametrize("chunksize, sample_size", [(50_000, 20_000), (1024, 20_000), (1024, 2_000)])
+def test_label_frame_agrees_with_full_kmeans(chunksize, sample_size):
+    df = synthetic_frame()
+    labels = label_frame(df, StreamingLabeller(df.columns), chunksize=chunksize, sample_size=sample_size)
+    assert agreement(labels, full_kmeans_labels(df, list(df.columns))) > MIN_AGREEMENT
+
+
+@pytest.mark.parametrize("name, label", [
+    ("building_mag", "mag_cluster"),
+    ("bikelane_mag", "mag_cluster"),
+    ("building_rad", "radar_cluster"),
+    ("bikelane_rad", "radar_cluster"),
+])
+@pytest.mark.parametrize("chunksize", [50_000, 1024])
+def test_label_frame_agrees_with_full_kmeans_on_stored_data(name, label, chunksize):
+    features = LABEL_FEATURES[label]
+    df = stored_frame(name)[features]
+    labels = label_frame(df, StreamingLabeller(features), chunksize=chunksize)
+    assert agreement(labels, full_kmeans_labels(df, features)) > MIN_AGREEMENT
+
+
+def test_label_stream_freezes_the_scaler():
+    df = synthetic_frame(20_000)
+    labeller = StreamingLabeller(df.columns)
+    chunks = list(label_stream(iter_chunks(df, 2_000), labeller, "mag_cluster"))
+    mean = labeller.scaler.mean_.copy()
+    list(label_stream(iter_chunks(df + 500.0, 2_000), labeller, "mag_cluster"))
+    assert np.array_equal(labeller.scaler.mean_, mean)
+    labels = pd.concat(chunks)["mag_cluster"].to_numpy()
+    assert agreement(labels, full_kmeans_labels(df, list(df.columns))) > MIN_AGREEMENT
+
+
+def test_labels_are_not_inverted():
+    df = synthetic_frame()
+    labels = label_frame(df, StreamingLabeller(df.columns))
+    # The shifted readings of a parked car are the detections
+    parked = (df["x"] > 60).to_numpy()
+    assert np.mean((labels == 'detection') == parked) > MIN_AGREEMENT
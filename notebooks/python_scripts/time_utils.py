@@ -0,0 +1,109 @@
+# Shared time normalization for the feature pipelines (notebooks 1 and 2).
+# The sensor API returns UTC timestamps, some with and some without microseconds.
+
+import time
+
+import numpy as np
+import pandas as pd
+
+# Timezone of the parking spots
+LOCAL_TZ = "Europe/Copenhagen"
+
+
+def parse_times(values):
+    """ Parses timestamps with and without microseconds in one vectorized pass, as UTC"""
+    return pd.to_datetime(values, format='ISO8601', utc=True)
+
+
+def normalize_time(df, column='time', to_local=True, hour_column='time_hour'):
+    """ Normalizes the time column of a sensor frame in place.
+
+    Adds `hour_column` with the UTC time floored to the hour, which is what the
+    Open-Meteo weather data is keyed on. With to_local the time column itself is
+    converted to Danish local time (CET/CEST, so DST is handled), otherwise it is
+    kept in UTC. Both columns are returned timezone naive like before.
+
+    Note that local times repeat for one hour when DST ends in October.
+    """
+    utc_time = parse_times(df[column])
+    df[hour_column] = utc_time.dt.floor('h').dt.tz_localize(None)
+    if to_local:
+        df[column] = utc_time.dt.tz_convert(LOCAL_TZ).dt.tz_localize(None)
+    else:
+        df[column] = utc_time.dt.tz_localize(None)
+    return df
+
+
+def utc_times(df):
+    """ The event times of a sensor frame in UTC, as datetime64 values.
+
+    After normalize_time(df, to_local=True) the time column is local time, which
+    repeats for one hour when DST ends. The UTC hour in time_hour plus the minutes
+    and seconds of the local time is the UTC time again (the offsets are whole hours).
+    """
+    times = pd.to_datetime(df['time'])
+    if 'time_hour' in df.columns:
+        times = pd.to_datetime(df['time_hour']) + (times - times.dt.floor('h'))
+    return times.to_numpy(dtype='datetime64[us]')
+
+
+# The row by row path the pipelines used before, kept for the benchmark below
+def _legacy_normalize_time(df):
+    from datetime import datetime
+
+    def parse_datetime(dt_str):
+        try:
+            return datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S.%f')
+        except ValueError:
+            return datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S')
+
+    df['time'] = df['time'].apply(parse_datetime)
+    df['time'] = pd.to_datetime(df['time'])
+    df['time_hour'] = df['time'].dt.strftime('%Y-%m-%d %H')
+    df['time_hour'] = pd.to_datetime(df['time_hour'])
+    df['time'] = df['time'] + pd.Timedelta(hours=2)
+    return df
+
+
+def _synthetic_times(n_rows, seed=0):
+    """ Two months of mixed format timestamps, like the historic CSVs"""
+    rng = np.random.default_rng(seed)
+    seconds = np.sort(rng.integers(0, 61 * 24 * 3600, n_rows))
+    times = pd.Timestamp("2024-03-01") + pd.to_timedelta(seconds, unit="s")
+    micro = pd.Series(times + pd.to_timedelta(rng.integers(1, 999999, n_rows), unit="us"))
+    with_micro = rng.random(n_rows) < 0.5
+    return pd.Series(np.where(
+        with_micro,
+        micro.dt.strftime('%Y-%m-%d %H:%M:%S.%f'),
+        pd.Series(times).dt.strftime('%Y-%m-%d %H:%M:%S'),
+    ))
+
+
+def benchmark(times=None, n_rows=200_000, repeat=3):
+    """ Times the legacy row by row path against normalize_time and prints the result"""
+    if times is None:
+        times = _synthetic_times(n_rows)
+    results = {}
+    for name, func in [("legacy", _legacy_normalize_time), ("normalize_time", normalize_time)]:
+        best = float("inf")
+        for _ in range(repeat):
+            df = pd.DataFrame({'time': times.astype(str)})
+            start = time.perf_counter()
+            func(df)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+        print(f"{name:>15}: {best:.3f} s for {len(times)} rows")
+    print(f"{'speedup':>15}: {results['legacy'] / results['normalize_time']:.1f}x")
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python time_utils.py [path/to/historic.csv ...]
+    import sys
+
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            print(path)
+            benchmark(pd.read_csv(path, usecols=['time'])['time'])
+    else:
+        benchmark()
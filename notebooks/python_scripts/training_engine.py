@@ -0,0 +1,259 @@
+# Training engine for the detection models.
+# Every model is described by a spec (feature view, features, label). The training data of
+# each spec is fetched once, then all specs and all points of the k/weights grid are
+# trained and evaluated in parallel in a process pool. The grid points are compared on a
+# validation split of the training data, the test split is only used for the final report:
+# the best grid point of every spec is refitted on the whole training data, scored on the
+# test split and saved as pickle and memory-mappable artifact, with its confusion matrix
+# and metrics.
+#
+# Usage: python training_engine.py [--model-dir ../models] [--workers 4] [--upload] [--no-cache]
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
+from sklearn.model_selection import train_test_split
+from sklearn.neighbors import KNeighborsClassifier
+
+from dataset_cache import DatasetCache
+from model_artifacts import save_knn_artifact
+from prediction_store import MAG_FEATURES, RADAR_FEATURES
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+TEST_SIZE = 0.2
+# Share of the training split held out to compare the grid points
+VALIDATION_SIZE = 0.25
+
+# "version" is the version of the feature view, "feature_group_version" the one of the feature group it is built on
+TRAINING_SPECS = [
+    {"name": "building_mag_hist_model", "feature_view": "hist_building_mag_fv", "version": 1,
+     "feature_group": "hist_combined_full_fg", "feature_group_version": 1, "psensor": "BUILDING",
+     "features": MAG_FEATURES, "label": "mag_cluster", "matrix": "knn_mag_building_confusion_matrix.png",
+     "description": "Predictions on the parking spot close to the building with magnetic data"},
+    {"name": "bikelane_mag_hist_model", "feature_view": "hist_bikelane_mag_fv", "version": 1,
+     "feature_group": "hist_combined_full_fg", "feature_group_version": 1, "psensor": "BIKELANE",
+     "features": MAG_FEATURES, "label": "mag_cluster", "matrix": "knn_mag_bikelane_matrix.png",
+     "description": "Predictions on the parking spot close to the bikelane with magnetic data"},
+    {"name": "building_rad_hist_model", "feature_view": "hist_building_radar_fv", "version": 1,
+     "feature_group": "hist_combined_radar_fg", "feature_group_version": 1, "psensor": "BUILDING",
+     "features": RADAR_FEATURES, "label": "radar_cluster", "matrix": "knn_rad_building_confusion_matrix.png",
+     "description": "Predictions on the parking spot close to the building with radar data"},
+    {"name": "bikelane_rad_hist_model", "feature_view": "hist_bikelane_radar_fv", "version": 1,
+     "feature_group": "hist_combined_radar_fg", "feature_group_version": 1, "psensor": "BIKELANE",
+     "features": RADAR_FEATURES, "label": "radar_cluster", "matrix": "knn_rad_bike_confusion_matrix.png",
+     "description": "Predictions on the parking spot close to the bikelane with radar data"},
+]
+
+# The current setting (k=2, uniform) comes first, so it wins ties
+PARAM_GRID = {"n_neighbors": [2, 1, 3, 5, 7], "weights": ["uniform", "distance"]}
+
+
+def grid_points(param_grid=PARAM_GRID):
+    keys = list(param_grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(param_grid[key] for key in keys))]
+
+
+def validation_split(X_train, y_train, validation_size=VALIDATION_SIZE, random_state=0):
+    """ Splits the training data into the rows the grid points are fitted on and the validation rows"""
+    y_train = np.asarray(y_train)
+    _, counts = np.unique(y_train, return_counts=True)
+    stratify = y_train if len(counts) > 1 and counts.min() >= 2 else None
+    return train_test_split(X_train, y_train, test_size=validation_size, random_state=random_state, stratify=stratify)
+
+
+def fetch_dataset(fs, spec, test_size=TEST_SIZE, cache=None, validation_size=VALIDATION_SIZE):
+    """ The train/test split of a spec, from the feature view or a dataset_cache.DatasetCache.
+
+    The training data is split once more into fit and validation rows for the grid search.
+    """
+    feature_view = fs.get_feature_view(spec["feature_view"], version=spec["version"])
+    if cache is not None:
+        X_train, X_test, y_train, y_test = cache.train_test_split(feature_view, test_size)
+    else:
+        X_train, X_test, y_train, y_test = feature_view.train_test_split(test_size)
+    dataset = {
+        "X_train": X_train[spec["features"]], "X_test": X_test[spec["features"]],
+        "y_train": y_train[spec["label"]].values.ravel(), "y_test": y_test[spec["label"]].values.ravel(),
+    }
+    dataset["X_fit"], dataset["X_val"], dataset["y_fit"], dataset["y_val"] = validation_split(
+        dataset["X_train"], dataset["y_train"], validation_size)
+    return dataset
+
+
+def fetch_datasets(fs, specs, cache=None, max_workers=4):
+    """ Fetches the split of every spec once, in threads since it is waiting on the feature store"""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        datasets = pool.map(lambda spec: fetch_dataset(fs, spec, cache=cache), specs)
+        return dict(zip([spec["name"] for spec in specs], datasets))
+
+
+# The datasets in a worker process, sent once per worker instead of once per grid point
+_datasets = None
+
+
+def _init_worker(datasets):
+    global _datasets
+    _datasets = datasets
+
+
+def evaluate_point(name, params):
+    """ Trains one grid point of one spec on the worker's fit rows and returns its validation accuracy"""
+    data = _datasets[name]
+    start = time.perf_counter()
+    model = KNeighborsClassifier(**params).fit(data["X_fit"], data["y_fit"])
+    return {
+        "name": name,
+        "params": params,
+        "val_accuracy": accuracy_score(data["y_val"], model.predict(data["X_val"])),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def run_grid(datasets, specs, param_grid=PARAM_GRID, max_workers=None):
+    """ Evaluates every spec x grid point in a process pool, returns the results per spec in grid order"""
+    points = grid_points(param_grid)
+    tasks = [(spec["name"], params) for spec in specs for params in points]
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(datasets,)) as pool:
+        results = list(pool.map(evaluate_point, *zip(*tasks)))
+    per_spec = {spec["name"]: [] for spec in specs}
+    for result in results:
+        per_spec[result["name"]].append(result)
+    return per_spec
+
+
+def best_result(results):
+    """ Highest validation accuracy, the first grid point wins ties"""
+    return max(results, key=lambda result: result["val_accuracy"])
+
+
+def test_report(model, dataset):
+    """ The metrics of a fitted model on the test split, only used to report the chosen grid point"""
+    y_pred = model.predict(dataset["X_test"])
+    return {
+        "accuracy": accuracy_score(dataset["y_test"], y_pred),
+        "report": classification_report(dataset["y_test"], y_pred, output_dict=True, zero_division=0),
+        "confusion_matrix": confusion_matrix(dataset["y_test"], y_pred, labels=model.classes_).tolist(),
+        "classes": model.classes_.tolist(),
+    }
+
+
+# How the classes are written in the confusion matrix plots
+CLASS_LABELS = {"detection": "Detection", "no_detection": "no Detection"}
+
+
+def save_confusion_matrix(result, path):
+    """ Saves the confusion matrix like the pictures/knn_*_confusion_matrix.png plots"""
+    from matplotlib import pyplot
+    import seaborn as sns
+
+    classes = [CLASS_LABELS.get(c, c) for c in result["classes"]]
+    df_cm = pd.DataFrame(result["confusion_matrix"], [f"True {c}" for c in classes], [f"Pred {c}" for c in classes])
+    fig = pyplot.figure()
+    sns.heatmap(df_cm, annot=True, fmt='g')
+    fig.savefig(path)
+    pyplot.close(fig)
+
+
+def save_model(spec, dataset, result, model_dir=MODEL_DIR):
+    """ Refits the best grid point on the spec's training data, scores it on the test split and
+    writes pickle, artifact, plot and metrics. Returns the model and the result with the test metrics
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    model = KNeighborsClassifier(**result["params"]).fit(dataset["X_train"], dataset["y_train"])
+    result = {**result, **test_report(model, dataset)}
+    joblib.dump(model, os.path.join(model_dir, spec["name"] + ".pkl"))
+    save_knn_artifact(model, model_dir, spec["name"])
+    save_confusion_matrix(result, os.path.join(model_dir, spec["matrix"]))
+    with open(os.path.join(model_dir, spec["name"] + "_metrics.json"), "w") as f:
+        json.dump({key: result[key] for key in ["params", "val_accuracy", "accuracy", "report", "confusion_matrix",
+                                                "classes"]}, f, indent=1)
+    return model, result
+
+
+def spec_files(spec):
+    """ The files save_model writes for a spec, relative to the model directory"""
+    return [spec["name"] + ".pkl", spec["name"], spec["matrix"], spec["name"] + "_metrics.json"]
+
+
+def upload_model(mr, spec, dataset, result, model_dir=MODEL_DIR):
+    """ Registers a saved model in the Hopsworks model registry, with a new version and its test accuracy.
+
+    Only the files of the spec are uploaded, copied to a temporary directory, not the
+    whole shared model directory.
+    """
+    from hsml.schema import Schema
+    from hsml.model_schema import ModelSchema
+
+    model_schema = ModelSchema(Schema(dataset["X_train"]), Schema(pd.DataFrame({spec["label"]: dataset["y_train"]})))
+    registry_model = mr.python.create_model(
+        name=spec["name"],
+        metrics={"accuracy": result["accuracy"]},
+        model_schema=model_schema,
+        input_example=dataset["X_train"].sample(),
+        description=spec["description"],)
+    with tempfile.TemporaryDirectory() as upload_dir:
+        for name in spec_files(spec):
+            source = os.path.join(model_dir, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(upload_dir, name))
+            elif os.path.exists(source):
+                shutil.copy2(source, upload_dir)
+        registry_model.save(upload_dir)
+    return registry_model
+
+
+def train_all(fs, specs=TRAINING_SPECS, param_grid=PARAM_GRID, model_dir=MODEL_DIR, max_workers=None, mr=None, cache=None):
+    """ Fetches, grid searches and saves every spec, uploads to mr if given. Returns the best result per spec"""
+    datasets = fetch_datasets(fs, specs, cache)
+    per_spec = run_grid(datasets, specs, param_grid, max_workers)
+    best = {}
+    for spec in specs:
+        _, result = save_model(spec, datasets[spec["name"]], best_result(per_spec[spec["name"]]), model_dir)
+        if mr is not None:
+            upload_model(mr, spec, datasets[spec["name"]], result, model_dir)
+        best[spec["name"]] = result
+    return best, per_spec
+
+
+def grid_report(per_spec):
+    """ Validation accuracy of every grid point, one row per spec and grid point"""
+    rows = [{"model": name, **result["params"], "val_accuracy": result["val_accuracy"], "seconds": result["seconds"]}
+            for name, results in per_spec.items() for result in results]
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    from local_feature_store import get_feature_store, use_local_feature_store
+
+    parser = argparse.ArgumentParser(description="Trains all detection models with a k/weights grid search")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="Processes, default is the number of CPUs")
+    parser.add_argument("--upload", action="store_true", help="Registers the models in the Hopsworks model registry")
+    parser.add_argument("--no-cache", action="store_true", help="Reads the training data from the feature views instead of the dataset cache")
+    args = parser.parse_args()
+
+    project = None
+    if not use_local_feature_store():
+        import hopsworks
+        project = hopsworks.login(project="annikaij")
+    fs = get_feature_store(project)
+    mr = project.get_model_registry() if args.upload else None
+
+    start = time.perf_counter()
+    cache = None if args.no_cache else DatasetCache()
+    best, per_spec = train_all(fs, model_dir=args.model_dir, max_workers=args.workers, mr=mr, cache=cache)
+    print(grid_report(per_spec).to_string(index=False))
+    for name, result in best.items():
+        print(f"{name}: {result['params']} validation accuracy {result['val_accuracy']:.4f}, "
+              f"test accuracy {result['accuracy']:.4f}")
+    print(f"Trained {len(best)} models in {time.perf_counter() - start:.1f}s")
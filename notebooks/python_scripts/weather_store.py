@@ -0,0 +1,250 @@
+# Local hourly weather store shared by the historic and latest feature pipelines.
+# Weather is kept in a Parquet file keyed by grid cell (rounded latitude/longitude)
+# and UTC hour, so every hour is only downloaded from Open-Meteo once.
+
+import os
+
+import numpy as np
+import pandas as pd
+import requests
+import openmeteo_requests
+from retry_requests import retry
+
+WEATHER_STORE_PATH = os.getenv(
+    "WEATHER_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "weather.parquet"),
+)
+
+# The hourly variables we use as features, in the order they are requested
+WEATHER_VARIABLES = ["temperature_2m", "relative_humidity_2m", "precipitation", "surface_pressure", "cloud_cover", "et0_fao_evapotranspiration", "wind_speed_10m", "soil_temperature_0_to_7cm", "soil_moisture_0_to_7cm"]
+
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+# The archive API lags a few days behind, newer hours come from the forecast API
+ARCHIVE_DELAY_DAYS = 5
+
+# Coordinates are rounded to this many decimals to define a grid cell
+GRID_DECIMALS = 2
+
+KEY_COLUMNS = ["latitude", "longitude", "date"]
+
+# Rows whose own hour is not in the store get the weather of the nearest stored hour within this gap
+MAX_FALLBACK_GAP = pd.Timedelta(hours=int(os.getenv("WEATHER_MAX_FALLBACK_HOURS", 3)))
+
+
+def grid_cell(latitude, longitude):
+    """ Returns the grid cell (rounded latitude, longitude) of a location"""
+    return (round(float(latitude), GRID_DECIMALS), round(float(longitude), GRID_DECIMALS))
+
+
+def create_client():
+    """ Setup the Open-Meteo API client with retry on error"""
+    retry_session = retry(requests.Session(), retries=5, backoff_factor=0.2)
+    return openmeteo_requests.Client(session=retry_session)
+
+
+class WeatherStore(object):
+
+    def __init__(self, path=WEATHER_STORE_PATH, client=None):
+        """ Opens the store, the Parquet file is created on the first fill"""
+        self.path = path
+        self.client = client
+        if os.path.exists(path):
+            self.data = pd.read_parquet(path)
+        else:
+            self.data = self._empty_frame()
+
+    @staticmethod
+    def _empty_frame():
+        columns = {"latitude": "float64", "longitude": "float64", "date": "datetime64[ns]"}
+        columns.update({variable: "float32" for variable in WEATHER_VARIABLES})
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in columns.items()})
+
+    @staticmethod
+    def _hours(start, end):
+        """ All UTC hours from start to end (inclusive), both floored to the hour"""
+        return pd.date_range(pd.Timestamp(start).floor('h'), pd.Timestamp(end).floor('h'), freq='h')
+
+    def missing_hours(self, cell, start, end):
+        """ Returns the hours in start..end that are not stored for the grid cell"""
+        hours = self._hours(start, end)
+        stored = self.data.loc[
+            (self.data["latitude"] == cell[0]) & (self.data["longitude"] == cell[1]), "date"
+        ]
+        return hours[~hours.isin(stored)]
+
+    def fill(self, locations, start, end):
+        """ Downloads the missing hours for all locations and saves them in the store.
+
+        All grid cells with missing hours are sent in one Open-Meteo request per
+        endpoint (archive for older hours, forecast for recent ones). Hours in the
+        future are not stored, as their forecast can still change.
+        Returns the number of new rows.
+        """
+        now = pd.Timestamp.now(tz='UTC').tz_localize(None)
+        end = min(pd.Timestamp(end), now.floor('h'))
+        cells = sorted({grid_cell(*location) for location in locations})
+        missing = {cell: self.missing_hours(cell, start, end) for cell in cells}
+        missing = {cell: hours for cell, hours in missing.items() if len(hours)}
+        if not missing:
+            return 0
+
+        first = min(hours.min() for hours in missing.values())
+        last = max(hours.max() for hours in missing.values())
+        archive_end = now.normalize() - pd.Timedelta(days=ARCHIVE_DELAY_DAYS)
+
+        frames = []
+        if first < archive_end:
+            frames.append(self._download(ARCHIVE_URL, list(missing), first, min(last, archive_end - pd.Timedelta(hours=1))))
+        if last >= archive_end:
+            frames.append(self._download(FORECAST_URL, list(missing), max(first, archive_end), last))
+
+        new = pd.concat(frames, ignore_index=True)
+        # Only keeping the past hours that are not stored yet and that the API had values for
+        new = new[new["date"] <= end]
+        new = new.dropna(subset=WEATHER_VARIABLES, how="all")
+        new = new.merge(self.data[KEY_COLUMNS], on=KEY_COLUMNS, how="left", indicator=True)
+        new = new[new["_merge"] == "left_only"].drop(columns=["_merge"])
+        if new.empty:
+            return 0
+
+        self.data = (pd.concat([self.data, new], ignore_index=True)
+                     .sort_values(KEY_COLUMNS, ignore_index=True))
+        self.save()
+        return len(new)
+
+    def _download(self, weather_url, cells, start, end):
+        """ Requests the hourly variables for several grid cells in one call"""
+        if self.client is None:
+            self.client = create_client()
+        weather_params = {
+            "latitude": [cell[0] for cell in cells],
+            "longitude": [cell[1] for cell in cells],
+            "start_date": start.strftime('%Y-%m-%d'),
+            "end_date": end.strftime('%Y-%m-%d'),
+            "hourly": WEATHER_VARIABLES,
+        }
+        responses = self.client.weather_api(weather_url, params=weather_params)
+
+        # The responses come back in the same order as the requested locations
+        frames = []
+        for cell, response in zip(cells, responses):
+            hourly = response.Hourly()
+            hourly_data = {"date": pd.date_range(
+                start = pd.to_datetime(hourly.Time(), unit = "s"),
+                end = pd.to_datetime(hourly.TimeEnd(), unit = "s"),
+                freq = pd.Timedelta(seconds = hourly.Interval()),
+                inclusive = "left"
+            )}
+            for i, variable in enumerate(WEATHER_VARIABLES):
+                hourly_data[variable] = hourly.Variables(i).ValuesAsNumpy().astype("float32")
+            frame = pd.DataFrame(data = hourly_data)
+            frame.insert(0, "longitude", cell[1])
+            frame.insert(0, "latitude", cell[0])
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    def save(self):
+        """ Writes the store atomically to its Parquet file"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        self.data.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, latitude, longitude, start, end, variables=WEATHER_VARIABLES):
+        """ Range query for one location, returns a dict of NumPy arrays with a 'date' key"""
+        cell = grid_cell(latitude, longitude)
+        mask = ((self.data["latitude"] == cell[0]) & (self.data["longitude"] == cell[1])
+                & self.data["date"].between(pd.Timestamp(start).floor('h'), pd.Timestamp(end)))
+        rows = self.data.loc[mask]
+        arrays = {"date": rows["date"].to_numpy()}
+        arrays.update({variable: rows[variable].to_numpy() for variable in variables})
+        return arrays
+
+    def get_frame(self, latitude, longitude, start, end, variables=WEATHER_VARIABLES):
+        """ Same as get, but as a DataFrame with a timezone naive UTC 'date' column for merging"""
+        return pd.DataFrame(self.get(latitude, longitude, start, end, variables))
+
+    def join(self, frames, locations, on='time_hour', variables=WEATHER_VARIABLES, max_gap=MAX_FALLBACK_GAP):
+        """ Attaches the weather to the frames of several sensors in one vectorized as-of join.
+
+        frames and locations are dicts keyed by the same names, `on` is a timezone
+        naive UTC time column (the hour or the time itself). The (grid cell, time) keys
+        of all rows are looked up at once in the stored weather, sorted by grid cell and
+        hour, and every row gets the weather of its hour. Rows whose hour is not stored
+        get the nearest stored hour within max_gap, otherwise missing values.
+        Returns a dict of the joined frames, with the rows in their original order.
+        """
+        cells = {name: grid_cell(*locations[name]) for name in frames}
+        cell_codes = {cell: code for code, cell in enumerate(sorted(set(cells.values())))}
+        weather = self.data.merge(pd.DataFrame([(lat, lon, code) for (lat, lon), code in cell_codes.items()],
+                                               columns=["latitude", "longitude", "_cell"]),
+                                  on=["latitude", "longitude"]).sort_values(["_cell", "date"], ignore_index=True)
+
+        # Keys of the rows of all frames, concatenated once: grid cell in the high bits, UTC seconds in the low bits
+        row_cells = np.concatenate([np.full(len(df), cell_codes[cells[name]], dtype=np.int64)
+                                    for name, df in frames.items()])
+        row_seconds = np.concatenate([_seconds(df[on]) for df in frames.values()])
+        weather_cells = weather["_cell"].to_numpy(dtype=np.int64)
+        weather_seconds = _seconds(weather["date"])
+        weather_keys = (weather_cells << 40) | weather_seconds
+
+        # The last stored hour at or before each row (as-of), used if it is the row's own hour
+        before = np.searchsorted(weather_keys, (row_cells << 40) | row_seconds, side="right") - 1
+        if len(weather_keys):
+            candidate = np.maximum(before, 0)
+            own_hour = ((before >= 0) & (weather_cells[candidate] == row_cells)
+                        & (row_seconds - weather_seconds[candidate] < 3600))
+        else:
+            # Nothing stored yet (e.g. the first fetch failed), every row gets missing weather
+            own_hour = np.zeros(len(before), dtype=bool)
+        match = np.where(own_hour, before, -1)
+
+        # The nearest stored hour within max_gap for the rows whose own hour is missing
+        missing = np.flatnonzero(~own_hour)
+        if len(missing) and len(weather_keys):
+            no_gap = np.iinfo(np.int64).max
+            previous, following = before[missing], np.minimum(before[missing] + 1, len(weather_keys) - 1)
+            cell, seconds = row_cells[missing], row_seconds[missing]
+            gap_previous = np.where((previous >= 0) & (weather_cells[np.maximum(previous, 0)] == cell),
+                                    seconds - weather_seconds[np.maximum(previous, 0)], no_gap)
+            gap_following = np.where((following > previous) & (weather_cells[following] == cell),
+                                     weather_seconds[following] - seconds, no_gap)
+            nearest = np.where(gap_previous <= gap_following, previous, following)
+            within_gap = np.minimum(gap_previous, gap_following) <= max_gap.total_seconds()
+            match[missing] = np.where(within_gap, nearest, -1)
+
+        matched = np.maximum(match, 0)
+        unmatched = match < 0
+        columns = {}
+        for variable in variables:
+            values = weather[variable].to_numpy()
+            if not np.issubdtype(values.dtype, np.floating):
+                values = values.astype(np.float64)
+            column = values.take(matched) if len(values) else np.empty(len(match), dtype=values.dtype)
+            column[unmatched] = np.nan
+            columns[variable] = column
+
+        result = {}
+        start = 0
+        for name, df in frames.items():
+            end = start + len(df)
+            result[name] = df.reset_index(drop=True).assign(**{variable: columns[variable][start:end]
+                                                               for variable in variables})
+            start = end
+        return result
+
+
+def _seconds(times):
+    """ Whole seconds since the epoch of a timezone naive datetime column"""
+    return pd.Series(times).to_numpy(dtype="datetime64[s]").astype(np.int64)
+
+
+if __name__ == "__main__":
+    # Usage: python weather_store.py 2024-03-01 2024-04-30
+    import sys
+    from sensor_api import SENSORS, get_location
+
+    store = WeatherStore()
+    n_rows = store.fill([get_location(dev_eui) for dev_eui in SENSORS], sys.argv[1], sys.argv[2] + " 23:00")
+    print(f"Stored {n_rows} new hours in {store.path}")
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+set -e
+
+cd notebooks/python_scripts
+#set the API_PASSWORD
+export API_PASSWORD=$API_PASSWORD
+export API_USERNAME=$API_USERNAME
+
+# Run the feature pipeline as a long-running service, stop it with Ctrl+C or SIGTERM
+exec python ingestion_service.py "$@"